@@ -1,16 +1,133 @@
+import csv
+import gc
+import heapq
+import importlib
+import itertools
+import json
 import math
 import logging
+import numbers
+import os
+import struct
+import time
+import weakref
+from collections import OrderedDict, namedtuple
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('gps.log'),
-        logging.StreamHandler()
-    ]
-)
+# importing gps configures no logging; call configure_logging() for the log file
 logger = logging.getLogger(__name__)
 
+LOG_FILE = "gps.log"
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is only imported when first used
+
+    The first attribute lookup imports the module and replaces the
+    stand-in in this module's globals, so later lookups cost nothing extra.
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+# NumPy takes longer to import than everything else together, so it is
+# deferred until first use: importing gps, haversine(), DistanceCache and
+# reading CSV files never load it. Any matching does, including the pure
+# Python backend, since validation and the reference tables use NumPy
+np = _LazyModule("numpy", "np")
+
+
+def configure_logging(path=LOG_FILE, level=logging.INFO):
+    """
+    Log to a file and to stderr, as scripts using gps usually want
+
+    The file is only created once something is logged.
+    """
+    logging.basicConfig(
+        level=level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(path, delay=True),
+            logging.StreamHandler()
+        ]
+    )
+
+EARTH_RADIUS_KM = 6371
+
+# gps_match switches to the NumPy backend once it has this many pairs to compare
+VECTORIZE_THRESHOLD = 10_000
+
+# largest number of distances the NumPy backend holds in memory at once
+CHUNK_SIZE = 2 ** 22
+
+# Cost of building the k-d tree per point of locations2, and of one tree
+# query, in NumPy distance computations. gps_match uses the tree once it is
+# cheaper than comparing every pair: for large locations1 that is once
+# locations2 has about KDTREE_QUERY_COST points, and a tree over 10^6 points
+# pays for itself from about 2,500 queries
+KDTREE_BUILD_COST = 2_500
+KDTREE_QUERY_COST = 25_000
+
+BACKENDS = ("python", "numpy", "kdtree", "geohash")
+
+ACCURACIES = ("exact", "fast")
+
+# internal backend for accuracy="fast"
+FAST_BACKEND = "numpy-fast"
+
+# bound on the error of a dot product of two unit vectors rounded to float32
+# and multiplied in float32: rounding the inputs contributes at most about
+# 1.1e-7 and the three products and two sums at most about 1.8e-7
+FAST_DOT_ERROR = 2.0 ** -21
+
+# accuracy="fast" rechecks up to this many candidates per point exactly
+FAST_CANDIDATES = 8
+
+# furthest, beyond the true closest point, that accuracy="fast" can match
+FAST_MAX_ERROR_KM = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(4 * FAST_DOT_ERROR) / 2)
+
+# gps_match splits locations1 into this many chunks per worker process
+CHUNKS_PER_WORKER = 4
+
+# number of points gps_match_stream reads and matches at a time
+STREAM_BATCH_SIZE = 10_000
+
+# validate_coordinates converts lists of at least this many points to an array
+VALIDATE_VECTORIZE_MIN = 64
+
+# coordinate types accepted point by point; numbers.Real covers NumPy scalars,
+# the plain types come first so the common case skips the ABC check
+_NUMBER_TYPES = (int, float, numbers.Real)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# GeohashIndex falls back to scanning every point once a search has expanded
+# this many rings of cells without finding a guaranteed nearest point
+GEOHASH_MAX_RINGS = 16
+
+# binary reference set files, see save_reference()
+REFERENCE_MAGIC = b"GPSREF\0\0"
+REFERENCE_VERSION = 2
+REFERENCE_HEADER = struct.Struct("<8sIIQI36x")
+REFERENCE_HAS_INDEX = 1
+
+# defaults for DistanceCache; 5 decimal places is about 1 m
+DISTANCE_CACHE_SIZE = 100_000
+DISTANCE_CACHE_PRECISION = 5
+# reference sets whose fingerprint a DistanceCache remembers
+DISTANCE_CACHE_REFERENCES = 4
+
+# phases of a gps_match call timed by instrumentation
+PHASES = ("validation", "index", "search")
+
+
 def haversine(lat1, lon1, lat2, lon2):
     """
     Calculate the great circle distance between two points
@@ -36,77 +153,1942 @@ def haversine(lat1, lon1, lat2, lon2):
     lat1 = (lat1) * math.pi / 180.0
     lat2 = (lat2) * math.pi / 180.0
 
-    logger.debug(f"dLat: {dLat}, dLon: {dLon}, lat1: {lat1}, lat2: {lat2}")
- 
     # apply formulae
     a = 1 - math.cos(dLat) + math.cos(lat1) * math.cos(lat2) * (1 - math.cos(dLon))
-    radius = 6371 # Earth radius in km
-    logger.info(f"Distance calculated: {2 * radius * math.asin(math.sqrt(a/2))}")
+    radius = EARTH_RADIUS_KM
     return 2 * radius * math.asin(math.sqrt(a/2))
 
+def haversine_matrix(lats1, lons1, lats2, lons2):
+    """
+    Calculate the great circle distance between every point of one set
+    and every point of another using NumPy broadcasting
+
+    Args:
+        lats1: latitudes of the first set, in decimal degrees
+        lons1: longitudes of the first set, in decimal degrees
+        lats2: latitudes of the second set, in decimal degrees
+        lons2: longitudes of the second set, in decimal degrees
+
+    Returns:
+        distances: array of shape (len(lats1), len(lats2)) in km
+    """
+
+    # same formula as haversine(), with the first set along rows
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(lons1, dtype=np.float64))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(lons2, dtype=np.float64))[np.newaxis, :]
+
+    a = 1 - np.cos(lat2 - lat1) + np.cos(lat1) * np.cos(lat2) * (1 - np.cos(lon2 - lon1))
+
+    # rounding can push a slightly outside [0, 2]
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a / 2, 0.0, 1.0)))
+
+
+def distance_matrix(locations1, locations2, out=None, dtype="float64", tile_size=CHUNK_SIZE):
+    """
+    Calculate the great circle distance between every point of one array
+    and every point of another, a block at a time
+
+    Each block holds at most tile_size distances and is computed in place
+    in two float64 work arrays of that size, so memory use does not grow
+    with the size of the matrix when out is a file: only the file's pages
+    that are being written need to be resident.
+
+    Args:
+        locations1: list of GPS locations, one row each
+        locations2: list of GPS locations, one column each
+        out: None to return a new array; a path to write a .npy file,
+            which np.load(path, mmap_mode="r") maps back; or an array
+            (e.g. an np.memmap) of shape (len(locations1), len(locations2))
+            to fill in
+        dtype: dtype of a new array or file, e.g. "float32" to halve its size
+        tile_size: largest number of distances computed at once
+
+    Returns:
+        distances: array of shape (len(locations1), len(locations2)) in km;
+        an np.memmap if out is a path
+    """
+    validate_coordinates(locations1, "locations1")
+    validate_coordinates(locations2, "locations2")
+    table1 = _ReferenceTable(locations1)
+    table2 = _ReferenceTable(locations2)
+    shape = (len(table1), len(table2))
+
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif isinstance(out, (str, bytes, os.PathLike)):
+        out = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    elif out.shape != shape:
+        raise ValueError(f"out must have shape {shape}, got {out.shape}")
+
+    # same formula as haversine_matrix(), with cos(lat) computed once per point
+    lat2 = table2.lat[np.newaxis, :]
+    lon2 = table2.lon[np.newaxis, :]
+    cos_lat2 = table2.cos_lat[np.newaxis, :]
+
+    # whole rows when they fit in a block, otherwise part of one row
+    cols = max(1, min(shape[1], tile_size))
+    rows = max(1, tile_size // cols)
+    work = np.empty(rows * cols)
+    term = np.empty(rows * cols)
+
+    for start in range(0, shape[0], rows):
+        stop = min(start + rows, shape[0])
+        lat1 = table1.lat[start:stop, np.newaxis]
+        lon1 = table1.lon[start:stop, np.newaxis]
+        cos_lat1 = table1.cos_lat[start:stop, np.newaxis]
+
+        for col_start in range(0, shape[1], cols):
+            col_stop = min(col_start + cols, shape[1])
+            block = (stop - start, col_stop - col_start)
+            a = work[:block[0] * block[1]].reshape(block)
+            b = term[:block[0] * block[1]].reshape(block)
+
+            np.subtract(lon2[:, col_start:col_stop], lon1, out=a)
+            np.cos(a, out=a)
+            np.subtract(1, a, out=a)
+            np.multiply(cos_lat1, cos_lat2[:, col_start:col_stop], out=b)
+            a *= b
+            np.subtract(lat2[:, col_start:col_stop], lat1, out=b)
+            np.cos(b, out=b)
+            np.subtract(1, b, out=b)
+            a += b
+            a /= 2
+            np.clip(a, 0.0, 1.0, out=a)
+            np.sqrt(a, out=a)
+            np.arcsin(a, out=a)
+            a *= 2 * EARTH_RADIUS_KM
+            out[start:stop, col_start:col_stop] = a
+
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+class CoordinateArray:
+    """
+    Compact container for GPS locations, stored as two float64 columns
+
+    Accepted anywhere a list of locations is. Indexing returns a (lat, lon)
+    tuple, or a CoordinateArray for a slice.
+    """
+
+    __slots__ = ("lats", "lons", "__weakref__")
+
+    def __init__(self, lats, lons):
+        self.lats = np.ascontiguousarray(lats, dtype=np.float64)
+        self.lons = np.ascontiguousarray(lons, dtype=np.float64)
+        if self.lats.ndim != 1 or self.lats.shape != self.lons.shape:
+            raise ValueError("lats and lons must be 1-dimensional and of the same length")
+
+    @classmethod
+    def from_points(cls, locations):
+        """Build from a sequence of (lat, lon) points or an (N, 2) array"""
+        points = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        return cls(points[:, 0], points[:, 1])
+
+    def __len__(self):
+        return len(self.lats)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CoordinateArray(self.lats[index], self.lons[index])
+        return (float(self.lats[index]), float(self.lons[index]))
+
+    def __iter__(self):
+        return zip(self.lats.tolist(), self.lons.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        points = np.column_stack((self.lats, self.lons))
+        return points if dtype is None else points.astype(dtype, copy=False)
+
+    def __repr__(self):
+        return f"CoordinateArray({len(self)} points)"
+
+    def to_numpy(self):
+        """(N, 2) array of the points"""
+        return np.column_stack((self.lats, self.lons))
+
+
+class MatchResult:
+    """
+    Columnar result of gps_match(..., columnar=True)
+
+    query_index[i] is the index of a point in locations1, match_index[i] the
+    index of its closest point in locations2 and distance[i] the distance
+    between them in km. Iterating yields (query_index, match_index, distance)
+    tuples.
+    """
+
+    __slots__ = ("query_index", "match_index", "distance")
+
+    def __init__(self, query_index, match_index, distance):
+        self.query_index = np.asarray(query_index, dtype=np.intp)
+        self.match_index = np.asarray(match_index, dtype=np.intp)
+        self.distance = np.asarray(distance, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.query_index)
+
+    def __iter__(self):
+        return zip(self.query_index.tolist(), self.match_index.tolist(), self.distance.tolist())
+
+    def __repr__(self):
+        return f"MatchResult({len(self)} matches)"
+
+    def to_list(self, locations1, locations2):
+        """Convert to gps_match's list of [point1, closest point2, distance] lists"""
+        return [[locations1[i], locations2[j], d] for i, j, d in self]
+
+
+def _tolist(values):
+    """Plain Python list of a backend's indices or distances"""
+    return values.tolist() if isinstance(values, np.ndarray) else values
+
+
+def _validate_array(points, name):
+    """Validate an (N, 2) numeric array with whole-array range checks"""
+    if points.ndim != 2 or points.shape[1] != 2 or len(points) == 0:
+        logger.error(f"{name} must be a non-empty array of shape (N, 2)")
+        raise ValueError(f"{name} must be a non-empty array of shape (N, 2), got {points.shape}")
+
+    if points.dtype.kind not in "biuf":
+        logger.error(f"Coordinates in {name} must be numbers")
+        raise ValueError(f"Coordinates in {name} must be numbers")
+
+    _validate_columns(points[:, 0], points[:, 1], name)
+
+
+def _validate_columns(lat, lon, name):
+    """Range-check latitude and longitude arrays"""
+    # written so that NaN fails both checks
+    bad_lat = ~((lat >= -90) & (lat <= 90))
+    if bad_lat.any():
+        index = int(np.flatnonzero(bad_lat)[0])
+        logger.error(f"Invalid latitude in {name} at index {index}: {lat[index]}")
+        raise ValueError(f"Invalid latitude in {name} at index {index}: {lat[index]}")
+
+    bad_lon = ~((lon >= -180) & (lon <= 180))
+    if bad_lon.any():
+        index = int(np.flatnonzero(bad_lon)[0])
+        logger.error(f"Invalid longitude in {name} at index {index}: {lon[index]}")
+        raise ValueError(f"Invalid longitude in {name} at index {index}: {lon[index]}")
+
+
 def validate_coordinates(locations, name="locations"):
-    """Validate GPS coordinate array format and values"""
-    logger.debug(f"Validating coordinates for {name}")
+    """
+    Validate GPS coordinate array format and values
+
+    CoordinateArrays, NumPy arrays, and lists/tuples of at least VALIDATE_VECTORIZE_MIN points
+    that convert to a numeric (N, 2) array, are checked with whole-array
+    operations. Anything else is checked point by point. Both checks accept
+    the same points: lists, tuples or NumPy rows of two numbers, including
+    NumPy scalars.
+    """
+    logger.debug("Validating coordinates for %s", name)
+    if isinstance(locations, np.ndarray):
+        _validate_array(locations, name)
+        return
+
+    if isinstance(locations, CoordinateArray):
+        if not len(locations):
+            logger.error(f"{name} must not be empty")
+            raise ValueError(f"{name} must not be empty")
+        _validate_columns(locations.lats, locations.lons, name)
+        return
+
     if not isinstance(locations, (list, tuple)) or not locations:
         logger.error(f"{name} must be a non-empty list/tuple")
         raise ValueError(f"{name} must be a non-empty list/tuple")
-    
-    for point in locations:
-        if not isinstance(point, (list, tuple)) or len(point) != 2:
+
+    if len(locations) >= VALIDATE_VECTORIZE_MIN:
+        try:
+            points = np.asarray(locations)
+        except (ValueError, TypeError):
+            # ragged input, fall through to find the bad point
+            points = None
+        if points is not None and points.ndim == 2 and points.shape[1] == 2 and points.dtype.kind in "biuf":
+            _validate_array(points, name)
+            return
+
+    for i, point in enumerate(locations):
+        if not isinstance(point, (list, tuple, np.ndarray)) or len(point) != 2:
             logger.error(f"Each point in {name} must be a list/tuple of length 2")
-            raise ValueError(f"Each point in {name} must be a list/tuple of length 2")
+            raise ValueError(f"Each point in {name} must be a list/tuple of length 2, got {point!r} at index {i}")
         
         lat, lon = point
-        if not isinstance(lat, (int, float)) or not isinstance(lon, (int, float)):
+        if not isinstance(lat, _NUMBER_TYPES) or not isinstance(lon, _NUMBER_TYPES):
             logger.error(f"Coordinates in {name} must be numbers")
-            raise ValueError(f"Coordinates in {name} must be numbers")
+            raise ValueError(f"Coordinates in {name} must be numbers, got {point!r} at index {i}")
             
         if not -90 <= lat <= 90:
-            logger.error(f"Invalid latitude in {name}: {lat}")
-            raise ValueError(f"Invalid latitude in {name}: {lat}")
+            logger.error(f"Invalid latitude in {name} at index {i}: {lat}")
+            raise ValueError(f"Invalid latitude in {name} at index {i}: {lat}")
         if not -180 <= lon <= 180:
-            logger.error(f"Invalid longitude in {name}: {lon}")
-            raise ValueError(f"Invalid longitude in {name}: {lon}")
+            logger.error(f"Invalid longitude in {name} at index {i}: {lon}")
+            raise ValueError(f"Invalid longitude in {name} at index {i}: {lon}")
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class DistanceCache:
+    """
+    Bounded LRU cache of distances and matches keyed on quantized coordinates
+
+    Coordinates are rounded to precision decimal places before lookup, so
+    points that round to the same coordinates share entries. distance()
+    caches the distance between a pair of rounded points, in either order.
+    gps_match(..., cache=...) caches the closest point and distance found
+    for each rounded point against a given locations2.
+
+    The fingerprint of a locations2 that cannot change, a read-only NumPy
+    array or a CoordinateArray with read-only columns such as
+    open_reference() returns, is computed once and remembered for that
+    object. Any other locations2 is fingerprinted on every call.
+    """
+
+    def __init__(self, maxsize=DISTANCE_CACHE_SIZE, precision=DISTANCE_CACHE_PRECISION):
+        self.maxsize = maxsize
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        # {id(locations): (weak reference to locations, fingerprint)} of
+        # read-only reference sets, least recently used first
+        self._references = OrderedDict()
+
+    def key(self, lat, lon):
+        """Quantized key of a point"""
+        return (round(lat, self.precision), round(lon, self.precision))
+
+    def get(self, key):
+        """Cached value for key, or None"""
+        value = self._cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Cache a value, evicting the least recently used entry if full"""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def remembers(self, locations):
+        """Whether the fingerprint of this read-only reference set object is remembered"""
+        entry = self._references.get(id(locations))
+        return entry is not None and entry[0]() is locations
+
+    def reference(self, locations):
+        """
+        Fingerprint of a reference set's rounded coordinates, which cached
+        matches are keyed on
+
+        Remembered for the DISTANCE_CACHE_REFERENCES most recently used
+        read-only sets, without keeping them alive; see _is_read_only.
+        """
+        if self.remembers(locations):
+            self._references.move_to_end(id(locations))
+            return self._references[id(locations)][1]
+
+        rounded = np.round(np.asarray(locations, dtype=np.float64), self.precision)
+        fingerprint = hash(rounded.tobytes())
+        if _is_read_only(locations):
+            key = id(locations)
+            forget = lambda _, references=self._references: references.pop(key, None)
+            self._references[key] = (weakref.ref(locations, forget), fingerprint)
+            if len(self._references) > DISTANCE_CACHE_REFERENCES:
+                self._references.popitem(last=False)
+        return fingerprint
+
+    def distance(self, lat1, lon1, lat2, lon2):
+        """Cached equivalent of haversine(lat1, lon1, lat2, lon2)"""
+        key1 = self.key(lat1, lon1)
+        key2 = self.key(lat2, lon2)
+        pair = (key1, key2) if key1 <= key2 else (key2, key1)
+
+        distance = self.get(pair)
+        if distance is None:
+            distance = haversine(pair[0][0], pair[0][1], pair[1][0], pair[1][1])
+            self.put(pair, distance)
+        return distance
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def cache_info(self):
+        """Hit and miss counts and size, like functools.lru_cache"""
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._cache))
 
+    def clear(self):
+        """Drop every entry and remembered fingerprint, and reset the statistics"""
+        self._cache.clear()
+        self._references.clear()
+        self.hits = 0
+        self.misses = 0
 
-def gps_match(locations1, locations2):
+
+def _is_read_only(locations):
+    """
+    Whether locations cannot be modified: a NumPy array, or a
+    CoordinateArray's columns, read-only along with every array it views
+    """
+    if isinstance(locations, CoordinateArray):
+        return _is_read_only(locations.lats) and _is_read_only(locations.lons)
+    if not isinstance(locations, np.ndarray):
+        return False
+    array = locations
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+def _column_view(array):
+    """
+    Sequence of a 1D array's values as Python numbers, without copying it
+
+    Indexing a memoryview makes a Python float or int from the array's
+    buffer, which is much faster than indexing the array itself. Arrays
+    not in native byte order, which memoryview cannot index, are copied
+    into a list instead.
+    """
+    if array.dtype.isnative:
+        return memoryview(array)
+    return array.tolist()
+
+
+def _rows_tolist(array):
+    """
+    array.tolist() for a 2D array, without the cyclic garbage collector
+    rescanning every new row list, which otherwise takes most of the time
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return array.tolist()
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def unit_vector(lat, lon):
+    """3D unit vector (x, y, z) of a point given in decimal degrees"""
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lon), cos_lat * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    """Great circle distance in km for a straight-line distance between two unit vectors"""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def km_to_chord(km):
+    """Straight-line distance between two unit vectors that are km apart on the earth"""
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+class SphereKDTree:
+    """
+    k-d tree over GPS locations, built once and queried many times
+
+    Points are stored as 3D unit vectors. The straight-line (chord) distance
+    between two unit vectors grows with their great circle distance, so the
+    point closest by chord is also the point closest by haversine, and the
+    tree can prune with plain axis-aligned splits. Only the winner of a
+    query has its distance computed with haversine().
+
+    The tree is implicit: points are reordered so that every range
+    [lo, hi) of more than leaf_size points splits at its middle element.
+    That order, the split axes and the unit vector columns in that order
+    are all there is to the tree, so save_reference() can store them and
+    open_reference_tree() can search the stored copy directly.
+    """
+
+    LEAF_SIZE = 16
+
+    # levels a trajectory search climbs from the previous match before
+    # searching from the root instead
+    CLIMB_LEVELS = 2
+
+    def __init__(self, locations, leaf_size=LEAF_SIZE, _layout=None):
+        self.leaf_size = leaf_size
+        # distances computed by nearest-point searches so far
+        self.evaluations = 0
+
+        if _layout is not None:
+            self._load(locations, *_layout)
+            return
+
+        validate_coordinates(locations, "locations")
+        table = _ReferenceTable(locations)
+        perm, axes = self._build(table.xyz, leaf_size)
+        xyz = table.xyz[perm]
+
+        self._index = perm.tolist()
+        self._axes = axes.tolist()
+        # x, y and z of the unit vectors, in tree order
+        self._coords = (xyz[:, 0].tolist(), xyz[:, 1].tolist(), xyz[:, 2].tolist())
+        self._lats = table.lats.tolist()
+        self._lons = table.lons.tolist()
+
+    def _load(self, locations, perm, axes, coords):
+        """
+        Set up a stored tree over a CoordinateArray from open_reference()
+
+        The locations were validated when the file was written. Every
+        column is searched in place through a memoryview, which reads
+        Python floats and ints straight from the mapped pages, so loading
+        does no work per point and the pages are shared between processes.
+        """
+        self._index = _column_view(perm)
+        self._axes = _column_view(axes)
+        self._coords = tuple(_column_view(column) for column in coords)
+        self._lats = _column_view(locations.lats)
+        self._lons = _column_view(locations.lons)
+
+    @staticmethod
+    def _build(xyz, leaf_size):
+        """Point order and split axes of the tree over unit vectors xyz"""
+        perm = np.arange(len(xyz))
+        axes = np.zeros(len(xyz), dtype=np.int8)
+
+        stack = [(0, len(xyz))]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo <= leaf_size:
+                continue
+
+            # split on the axis with the largest spread
+            sub = xyz[perm[lo:hi]]
+            axis = int(np.argmax(sub.max(axis=0) - sub.min(axis=0)))
+            mid = (lo + hi) // 2
+
+            order = np.argpartition(sub[:, axis], mid - lo)
+            perm[lo:hi] = perm[lo:hi][order]
+            axes[mid] = axis
+
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+
+        return perm, axes
+
+    def __len__(self):
+        return len(self._index)
+
+    def _nearest(self, x, y, z, deleted=None):
+        """
+        Tree position and squared chord distance of the point closest to (x, y, z)
+
+        Points whose index is in deleted are skipped. Returns (-1, inf) if
+        every point is skipped.
+        """
+        return self._search(x, y, z, 0, len(self._index), -1, math.inf, deleted)
+
+    def _search(self, x, y, z, lo, hi, best, best_d2, deleted=None):
+        """
+        Improve on the best tree position and squared chord distance found
+        so far with the points of the subtree [lo, hi)
+        """
+        query = (x, y, z)
+        coords = self._coords
+        xs, ys, zs = coords
+        index = self._index
+        axes = self._axes
+        leaf_size = self.leaf_size
+
+        evaluations = 0
+
+        # each entry is a range of the tree and a lower bound on its squared distance
+        stack = [(lo, hi, 0.0)]
+        while stack:
+            lo, hi, bound = stack.pop()
+            if bound > best_d2:
+                continue
+
+            if hi - lo <= leaf_size:
+                evaluations += hi - lo
+                for i in range(lo, hi):
+                    if deleted and index[i] in deleted:
+                        continue
+                    d2 = (xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2
+                    # ties go to the earliest point, as in the other backends
+                    if d2 < best_d2 or (d2 == best_d2 and index[i] < index[best]):
+                        best, best_d2 = i, d2
+                continue
+
+            mid = (lo + hi) // 2
+            evaluations += 1
+            if not (deleted and index[mid] in deleted):
+                d2 = (xs[mid] - x) ** 2 + (ys[mid] - y) ** 2 + (zs[mid] - z) ** 2
+                if d2 < best_d2 or (d2 == best_d2 and index[mid] < index[best]):
+                    best, best_d2 = mid, d2
+
+            axis = axes[mid]
+            diff = query[axis] - coords[axis][mid]
+            if diff < 0:
+                stack.append((mid + 1, hi, max(bound, diff * diff)))
+                stack.append((lo, mid, bound))
+            else:
+                stack.append((lo, mid, max(bound, diff * diff)))
+                stack.append((mid + 1, hi, bound))
+
+        self.evaluations += evaluations
+        return best, best_d2
+
+    def _knn(self, x, y, z, k):
+        """Tree positions and squared chord distances of the k points closest to (x, y, z), closest first"""
+        query = (x, y, z)
+        coords = self._coords
+        xs, ys, zs = coords
+        index = self._index
+        axes = self._axes
+        leaf_size = self.leaf_size
+
+        # max-heap of the best k so far as (-d2, -index, position), worst on top
+        heap = []
+
+        def consider(i):
+            entry = (-((xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2), -index[i], i)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+
+        stack = [(0, len(index), 0.0)]
+        while stack:
+            lo, hi, bound = stack.pop()
+            if len(heap) == k and bound > -heap[0][0]:
+                continue
+
+            if hi - lo <= leaf_size:
+                for i in range(lo, hi):
+                    consider(i)
+                continue
+
+            mid = (lo + hi) // 2
+            consider(mid)
+
+            axis = axes[mid]
+            diff = query[axis] - coords[axis][mid]
+            if diff < 0:
+                stack.append((mid + 1, hi, max(bound, diff * diff)))
+                stack.append((lo, mid, bound))
+            else:
+                stack.append((lo, mid, max(bound, diff * diff)))
+                stack.append((mid + 1, hi, bound))
+
+        return [(position, -d2) for d2, _, position in sorted(heap, reverse=True)]
+
+    def _within(self, x, y, z, radius2, deleted=None):
+        """Tree positions of the points within squared chord distance radius2 of (x, y, z)"""
+        query = (x, y, z)
+        coords = self._coords
+        xs, ys, zs = coords
+        index = self._index
+        axes = self._axes
+        leaf_size = self.leaf_size
+
+        found = []
+        stack = [(0, len(index))]
+        while stack:
+            lo, hi = stack.pop()
+
+            if hi - lo <= leaf_size:
+                for i in range(lo, hi):
+                    if (xs[i] - x) ** 2 + (ys[i] - y) ** 2 + (zs[i] - z) ** 2 <= radius2:
+                        if not (deleted and index[i] in deleted):
+                            found.append(i)
+                continue
+
+            mid = (lo + hi) // 2
+            if (xs[mid] - x) ** 2 + (ys[mid] - y) ** 2 + (zs[mid] - z) ** 2 <= radius2:
+                if not (deleted and index[mid] in deleted):
+                    found.append(mid)
+
+            # points before mid are at or below the split, points after it at or above
+            axis = axes[mid]
+            diff = query[axis] - coords[axis][mid]
+            if diff < 0 or diff * diff <= radius2:
+                stack.append((lo, mid))
+            if diff >= 0 or diff * diff <= radius2:
+                stack.append((mid + 1, hi))
+
+        return found
+
+    def query(self, lat, lon):
+        """
+        Find the closest indexed point
+
+        Args:
+            lat: latitude of the query point
+            lon: longitude of the query point
+
+        Returns:
+            (index of the closest point in the indexed locations, distance in km)
+        """
+        best, _ = self._nearest(*unit_vector(lat, lon))
+        index = self._index[best]
+        return index, haversine(lat, lon, self._lats[index], self._lons[index])
+
+    def query_many(self, locations):
+        """
+        Find the closest indexed point for each of many points
+
+        Returns:
+            (list of indices, list of distances in km)
+        """
+        indices = []
+        distances = []
+        for lat, lon in locations:
+            index, distance = self.query(lat, lon)
+            indices.append(index)
+            distances.append(distance)
+        return indices, distances
+
+    def _path_to(self, hint):
+        """
+        Subtrees on the way from the root down to the one holding tree
+        position hint
+
+        Returns:
+            (list of (lo, hi, mid, axis, split value, whether hint is below
+            mid) for each subtree on the way, lo, hi of the last subtree)
+        """
+        coords = self._coords
+        axes = self._axes
+        path = []
+        lo, hi = 0, len(self._index)
+        while hi - lo > self.leaf_size:
+            mid = (lo + hi) // 2
+            if hint == mid:
+                break
+            axis = axes[mid]
+            path.append((lo, hi, mid, axis, coords[axis][mid], hint < mid))
+            if hint < mid:
+                hi = mid
+            else:
+                lo = mid + 1
+        return path, lo, hi
+
+    def _nearest_from(self, x, y, z, path, lo, hi):
+        """
+        Version of _nearest that searches outward from the subtree [lo, hi)
+        at the end of path (see _path_to) instead of down from the root
+
+        That subtree is searched first, then the enclosing ones in turn,
+        stopping as soon as the sphere around the query through the best
+        point found lies inside the current subtree's region: nothing
+        outside it can be closer. When the subtree holds a point near the
+        answer that happens within a level or two.
+        """
+        query = (x, y, z)
+
+        # how far the query is inside the region of each subtree on the
+        # path (negative if outside)
+        margins = []
+        margin = math.inf
+        for _, _, _, axis, value, below in path:
+            margins.append(margin)
+            diff = query[axis] - value
+            if below:
+                diff = -diff
+            if diff < margin:
+                margin = diff
+
+        best, best_d2 = self._search(x, y, z, lo, hi, -1, math.inf)
+
+        level = len(path)
+        while margin > 0 and level > len(path) - self.CLIMB_LEVELS and level > 0:
+            if margin * margin > best_d2:
+                return best, best_d2
+
+            # the rest of the parent: its split point and the other child
+            level -= 1
+            parent_lo, parent_hi, mid, _, _, below = path[level]
+            sibling = (mid + 1, parent_hi) if below else (parent_lo, mid)
+            best, best_d2 = self._search(x, y, z, mid, mid + 1, best, best_d2)
+            best, best_d2 = self._search(x, y, z, sibling[0], sibling[1], best, best_d2)
+            margin = margins[level]
+
+        if margin * margin > best_d2:
+            return best, best_d2
+        # the answer may be far from the subtree, which a search from the
+        # root finds faster than climbing; the best so far still prunes it
+        return self._search(x, y, z, 0, len(self._index), best, best_d2)
+
+    def query_trajectory(self, locations):
+        """
+        Find the closest indexed point for each point of an ordered trace
+
+        Consecutive points of a trace are close together, so each search
+        starts from the previous point's match.
+
+        Returns:
+            (list of indices, list of distances in km)
+        """
+        indices = []
+        distances = []
+        position = hint = -1
+        for lat, lon in locations:
+            if position < 0:
+                position, _ = self._nearest(*unit_vector(lat, lon))
+            else:
+                if position != hint:
+                    hint = position
+                    path, lo, hi = self._path_to(hint)
+                position, _ = self._nearest_from(*unit_vector(lat, lon), path, lo, hi)
+            index = self._index[position]
+            indices.append(index)
+            distances.append(haversine(lat, lon, self._lats[index], self._lons[index]))
+        return indices, distances
+
+    def query_k(self, lat, lon, k):
+        """
+        Find the k closest indexed points
+
+        Returns:
+            List of (index, distance in km), closest first; shorter than k
+            if fewer points are indexed
+        """
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+
+        matches = []
+        for position, _ in self._knn(*unit_vector(lat, lon), k):
+            index = self._index[position]
+            matches.append((index, haversine(lat, lon, self._lats[index], self._lons[index])))
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+    def query_radius(self, lat, lon, km):
+        """
+        Find every indexed point within km of a point
+
+        Returns:
+            List of (index, distance in km), closest first
+        """
+        positions = self._within(*unit_vector(lat, lon), km_to_chord(km) ** 2)
+        matches = []
+        for position in positions:
+            index = self._index[position]
+            distance = haversine(lat, lon, self._lats[index], self._lons[index])
+            # the chord test and haversine can disagree by rounding at the edge
+            if distance <= km:
+                matches.append((index, distance))
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+
+def _geohash_bits(precision):
+    """Number of (latitude, longitude) bits in a geohash of precision characters"""
+    bits = 5 * precision
+    return bits // 2, bits - bits // 2
+
+
+def _geohash_cell(lat, lon, lat_bits, lon_bits):
+    """Row and column of the geohash cell containing a point"""
+    rows = 1 << lat_bits
+    cols = 1 << lon_bits
+    return (min(int((lat + 90) / 180 * rows), rows - 1),
+            min(int((lon + 180) / 360 * cols), cols - 1))
+
+
+def geohash_encode(lat, lon, precision=8):
+    """
+    Geohash of a point
+
+    Args:
+        lat: latitude in decimal degrees
+        lon: longitude in decimal degrees
+        precision: number of characters
+
+    Returns:
+        geohash string
+    """
+    lat_bits, lon_bits = _geohash_bits(precision)
+    row, col = _geohash_cell(lat, lon, lat_bits, lon_bits)
+
+    # bits alternate starting with longitude, most significant first
+    value = 0
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            lon_bits -= 1
+            value = (value << 1) | ((col >> lon_bits) & 1)
+        else:
+            lat_bits -= 1
+            value = (value << 1) | ((row >> lat_bits) & 1)
+
+    return "".join(GEOHASH_ALPHABET[(value >> shift) & 31] for shift in range(5 * precision - 5, -1, -5))
+
+
+class GeohashIndex:
+    """
+    GPS locations bucketed by geohash cell for nearest-neighbour queries
+
+    A query scans the cell containing it, then rings of neighbouring cells
+    further and further out, until the closest point found is nearer than
+    anything outside the scanned rectangle can be. If that takes more than
+    GEOHASH_MAX_RINGS rings (the query is far from every point), it scans
+    every point instead.
+
+    By default the precision is picked so that there are about as many
+    cells as points.
+    """
+
+    def __init__(self, locations, precision=None):
+        validate_coordinates(locations, "locations")
+
+        table = _ReferenceTable(locations)
+        if precision is None:
+            precision = max(1, min(8, round(math.log(len(table), 32))))
+
+        self.precision = precision
+        self._lat_bits, self._lon_bits = _geohash_bits(precision)
+        self._rows = 1 << self._lat_bits
+        self._cols = 1 << self._lon_bits
+        self._cell_height = 180 / self._rows
+        self._cell_width = 360 / self._cols
+
+        rows = np.minimum(((table.lats + 90) / 180 * self._rows).astype(np.int64), self._rows - 1)
+        cols = np.minimum(((table.lons + 180) / 360 * self._cols).astype(np.int64), self._cols - 1)
+        cells = rows * self._cols + cols
+
+        # group point indices by cell
+        order = np.argsort(cells, kind="stable")
+        keys, starts = np.unique(cells[order], return_index=True)
+        groups = np.split(order, starts[1:])
+        self._buckets = {int(key): group.tolist() for key, group in zip(keys, groups)}
+
+        # distances computed by nearest-point searches so far
+        self.evaluations = 0
+        self._table = table
+        self._xyz = _rows_tolist(table.xyz)
+        self._lats = table.lats.tolist()
+        self._lons = table.lons.tolist()
+
+    def __len__(self):
+        return len(self._xyz)
+
+    def _ring(self, row, col, r):
+        """Keys of the cells at Chebyshev distance r from (row, col), wrapping in longitude"""
+        cols = self._cols
+        if 2 * r + 1 >= cols:
+            ring_cols = range(cols)
+        else:
+            ring_cols = [(col + dc) % cols for dc in range(-r, r + 1)]
+
+        for dr in range(-r, r + 1):
+            cell_row = row + dr
+            if not 0 <= cell_row < self._rows:
+                continue
+            if abs(dr) == r:
+                for cell_col in ring_cols:
+                    yield cell_row * cols + cell_col
+            elif 2 * r - 1 < cols:
+                # the sides of the ring, unless ring r - 1 already wrapped all the way round
+                yield cell_row * cols + (col - r) % cols
+                if (col - r) % cols != (col + r) % cols:
+                    yield cell_row * cols + (col + r) % cols
+
+    def _bound(self, lat, lon, row, col, r):
+        """
+        Lower bound, in radians, on the distance from a query to any point
+        outside the rectangle of cells within r of its cell; inf once the
+        rectangle covers everything
+        """
+        lat_gap = math.inf
+        if row - r > 0:
+            lat_gap = lat - ((row - r) * self._cell_height - 90)
+        if row + r + 1 < self._rows:
+            lat_gap = min(lat_gap, (row + r + 1) * self._cell_height - 90 - lat)
+
+        lon_bound = math.inf
+        if 2 * r + 1 < self._cols:
+            lon_gap = min(lon - ((col - r) * self._cell_width - 180),
+                          (col + r + 1) * self._cell_width - 180 - lon)
+            # distance from the query to the meridian lon_gap away
+            lon_bound = math.asin(min(1.0, math.cos(math.radians(lat)) * math.sin(min(math.radians(lon_gap), math.pi / 2))))
+
+        return min(math.radians(lat_gap), lon_bound)
+
+    def _nearest(self, lat, lon):
+        """Index and squared chord distance of the point closest to (lat, lon)"""
+        x, y, z = unit_vector(lat, lon)
+        row, col = _geohash_cell(lat, lon, self._lat_bits, self._lon_bits)
+        xyz = self._xyz
+
+        best = -1
+        best_d2 = math.inf
+        for r in range(GEOHASH_MAX_RINGS + 1):
+            for key in self._ring(row, col, r):
+                bucket = self._buckets.get(key, ())
+                self.evaluations += len(bucket)
+                for i in bucket:
+                    px, py, pz = xyz[i]
+                    d2 = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+                    if d2 < best_d2 or (d2 == best_d2 and i < best):
+                        best, best_d2 = i, d2
+
+            bound = self._bound(lat, lon, row, col, r)
+            if bound == math.inf or best_d2 <= (2 * math.sin(min(bound, math.pi) / 2)) ** 2:
+                return best, best_d2
+
+        # too far from every point for rings to pay off
+        self.evaluations += len(xyz)
+        d2 = ((self._table.xyz - (x, y, z)) ** 2).sum(axis=1)
+        best = int(d2.argmin())
+        return best, float(d2[best])
+
+    def query(self, lat, lon):
+        """
+        Find the closest indexed point
+
+        Returns:
+            (index of the closest point in the indexed locations, distance in km)
+        """
+        index, _ = self._nearest(lat, lon)
+        return index, haversine(lat, lon, self._lats[index], self._lons[index])
+
+    def query_many(self, locations):
+        """
+        Find the closest indexed point for each of many points
+
+        Returns:
+            (list of indices, list of distances in km)
+        """
+        indices = []
+        distances = []
+        for lat, lon in locations:
+            index, distance = self.query(lat, lon)
+            indices.append(index)
+            distances.append(distance)
+        return indices, distances
+
+
+class GPSIndex:
+    """
+    Reference set of GPS locations that can be queried and updated in place
+
+    Points are identified by keys: the initial locations get keys
+    0..len(locations) - 1 and each add() returns the next unused key.
+    Queries use a SphereKDTree over the points present at the last rebuild,
+    plus a linear scan of points added since; removed points stay in the
+    tree but are skipped. The tree refers to points by their position in
+    _tree_keys. The tree is rebuilt once either kind of change
+    exceeds rebuild_ratio of its size.
+    """
+
+    REBUILD_RATIO = 0.25
+
+    # never rebuild for fewer pending changes than this
+    REBUILD_MIN = 64
+
+    def __init__(self, locations=(), rebuild_ratio=REBUILD_RATIO):
+        if len(locations):
+            validate_coordinates(locations, "locations")
+
+        self.rebuild_ratio = rebuild_ratio
+        self._points = dict(enumerate(locations))
+        self._next_key = len(self._points)
+        self._tree = None
+        self._tree_keys = []
+        self._tree_positions = {}
+        self._pending = {}
+        self._removed = set()
+        self.rebuild()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def __getitem__(self, key):
+        return self._points[key]
+
+    def add(self, point):
+        """Add a point to the index and return its key"""
+        validate_coordinates([point], "point")
+
+        key = self._next_key
+        self._next_key += 1
+        self._points[key] = point
+        self._pending[key] = unit_vector(point[0], point[1])
+        self._maybe_rebuild()
+        return key
+
+    def remove(self, key):
+        """Remove the point with the given key"""
+        if key not in self._points:
+            raise KeyError(key)
+
+        del self._points[key]
+        if key in self._pending:
+            del self._pending[key]
+        else:
+            self._removed.add(self._tree_positions[key])
+        self._maybe_rebuild()
+
+    def rebuild(self):
+        """Rebuild the tree from the current points"""
+        self._tree_keys = list(self._points)
+        self._tree_positions = {key: i for i, key in enumerate(self._tree_keys)}
+        points = [self._points[key] for key in self._tree_keys]
+        self._tree = SphereKDTree(points) if points else None
+        self._pending = {}
+        self._removed = set()
+
+    def _maybe_rebuild(self):
+        limit = max(self.REBUILD_MIN, self.rebuild_ratio * len(self._tree_keys))
+        if len(self._pending) > limit or len(self._removed) > limit:
+            self.rebuild()
+
+    def _nearest(self, lat, lon):
+        x, y, z = unit_vector(lat, lon)
+        best_key = None
+        best_d2 = math.inf
+
+        if self._tree is not None:
+            position, best_d2 = self._tree._nearest(x, y, z, self._removed)
+            if position >= 0:
+                best_key = self._tree_keys[self._tree._index[position]]
+
+        for key, (px, py, pz) in self._pending.items():
+            d2 = (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2
+            if d2 < best_d2:
+                best_key, best_d2 = key, d2
+
+        if best_key is None:
+            raise ValueError("GPSIndex is empty")
+
+        point = self._points[best_key]
+        return best_key, haversine(lat, lon, point[0], point[1])
+
+    def nearest(self, point):
+        """
+        Find the closest point in the index
+
+        Returns:
+            (key of the closest point, distance in km)
+        """
+        validate_coordinates([point], "point")
+        return self._nearest(point[0], point[1])
+
+    def nearest_many(self, points):
+        """
+        Find the closest point in the index for each of many points
+
+        Returns:
+            (list of keys, list of distances in km)
+        """
+        validate_coordinates(points, "points")
+
+        keys = []
+        distances = []
+        for lat, lon in points:
+            key, distance = self._nearest(lat, lon)
+            keys.append(key)
+            distances.append(distance)
+        return keys, distances
+
+    def within_radius(self, point, km):
+        """
+        Find every point in the index within km of a point
+
+        Returns:
+            List of (key, distance in km), closest first
+        """
+        validate_coordinates([point], "point")
+        lat, lon = point
+        x, y, z = unit_vector(lat, lon)
+        radius2 = km_to_chord(km) ** 2
+
+        keys = []
+        if self._tree is not None:
+            positions = self._tree._within(x, y, z, radius2, self._removed)
+            keys = [self._tree_keys[self._tree._index[position]] for position in positions]
+        keys += [key for key, (px, py, pz) in self._pending.items()
+                 if (px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2 <= radius2]
+
+        matches = []
+        for key in keys:
+            distance = haversine(lat, lon, self._points[key][0], self._points[key][1])
+            if distance <= km:
+                matches.append((key, distance))
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+
+class _ReferenceTable:
+    """
+    Values of locations2 that matching needs for every point of locations1,
+    computed once: coordinates in degrees and radians, cos(lat) and 3D unit
+    vectors
+    """
+
+    def __init__(self, locations):
+        points = np.asarray(locations, dtype=np.float64)
+        self.lats = points[:, 0]
+        self.lons = points[:, 1]
+        self.lat = np.radians(self.lats)
+        self.lon = np.radians(self.lons)
+        self.cos_lat = np.cos(self.lat)
+        self.xyz = np.column_stack((self.cos_lat * np.cos(self.lon),
+                                    self.cos_lat * np.sin(self.lon),
+                                    np.sin(self.lat)))
+
+    def __len__(self):
+        return len(self.lat)
+
+
+def _reference_table(locations):
+    return locations if isinstance(locations, _ReferenceTable) else _ReferenceTable(locations)
+
+
+def _match_python(locations1, locations2):
+    """
+    Index and distance of the closest point in locations2 for each point in locations1
+
+    Candidates are compared by squared chord distance between unit vectors,
+    which orders them the same way as haversine distance; only the closest
+    gets its distance computed with haversine().
+    """
+    table = _reference_table(locations2)
+    xyz = _rows_tolist(table.xyz)
+    lats = table.lats.tolist()
+    lons = table.lons.tolist()
+
+    indices = []
+    distances = []
+
+    for point1 in locations1:
+        x, y, z = unit_vector(point1[0], point1[1])
+
+        # calculate distances between point1 and all points in locations2
+        chords = [(px - x) ** 2 + (py - y) ** 2 + (pz - z) ** 2 for px, py, pz in xyz]
+
+        # find the index of the minimum distance
+        index = chords.index(min(chords))
+        indices.append(index)
+        distances.append(haversine(point1[0], point1[1], lats[index], lons[index]))
+
+    return indices, distances
+
+
+def _match_numpy(locations1, locations2, chunk_size=CHUNK_SIZE):
+    """
+    Vectorized version of _match_python
+
+    The closest point maximizes the dot product of unit vectors, so each
+    block of rows is a single matrix product. Blocks are sized so that no
+    more than chunk_size products are held in memory.
+    """
+    table = _reference_table(locations2)
+    points1 = np.asarray(locations1, dtype=np.float64)
+    xyz1 = _ReferenceTable(points1)
+
+    rows = max(1, chunk_size // len(table))
+    indices = np.empty(len(points1), dtype=np.intp)
+
+    for start in range(0, len(points1), rows):
+        block = xyz1.xyz[start:start + rows]
+        indices[start:start + len(block)] = (block @ table.xyz.T).argmax(axis=1)
+
+    # haversine for the winners only, reusing the precomputed cos(lat)
+    lat2 = table.lat[indices]
+    a = (1 - np.cos(lat2 - xyz1.lat)
+         + xyz1.cos_lat * table.cos_lat[indices] * (1 - np.cos(table.lon[indices] - xyz1.lon)))
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a / 2, 0.0, 1.0)))
+
+    return indices, distances
+
+
+def _match_fast(locations1, locations2, candidates=FAST_CANDIDATES, chunk_size=CHUNK_SIZE):
+    """
+    Version of _match_numpy that ranks candidates in float32
+
+    Each block's dot products are a float32 matrix product, about twice as
+    fast as float64 and half the memory. Every point whose float32 dot
+    product is within 2 * FAST_DOT_ERROR of the best is a candidate: the
+    true closest point is always among them. Points with more than one
+    candidate have up to `candidates` of them, the best by float32,
+    compared again in float64, and the winner's distance is computed with
+    haversine as usual.
+
+    So the result is exact unless more than `candidates` points lie within
+    the float32 error band of the closest one. Even then the returned point
+    is one whose squared chord distance exceeds the closest point's by at
+    most 4 * FAST_DOT_ERROR, i.e. it is at most FAST_MAX_ERROR_KM (about
+    8.8 km) further away, and less than that once the closest point is
+    more than a few km away.
+    """
+    table = _reference_table(locations2)
+    points1 = np.asarray(locations1, dtype=np.float64)
+    xyz1 = _ReferenceTable(points1)
+    xyz2_32 = table.xyz.astype(np.float32)
+
+    rows = max(1, chunk_size // len(table))
+    candidates = min(candidates, len(table))
+    indices = np.empty(len(points1), dtype=np.intp)
+
+    for start in range(0, len(points1), rows):
+        block = xyz1.xyz[start:start + rows]
+        dots = block.astype(np.float32) @ xyz2_32.T
+
+        rows_range = np.arange(len(block))
+        best = dots.argmax(axis=1)
+        top = dots[rows_range, best]
+
+        # a row is ambiguous if its runner-up is within the error band
+        dots[rows_range, best] = -2
+        ambiguous = np.flatnonzero(dots.max(axis=1) >= top - 2 * FAST_DOT_ERROR)
+        dots[rows_range, best] = top
+
+        if len(ambiguous):
+            # float32's best few for each ambiguous row, compared in float64
+            if candidates < len(table):
+                cands = np.argpartition(-dots[ambiguous], candidates - 1, axis=1)[:, :candidates]
+            else:
+                cands = np.broadcast_to(np.arange(len(table)), (len(ambiguous), len(table)))
+
+            # sorted so that ties go to the earliest point, as in the other backends
+            cands = np.sort(cands, axis=1)
+            chords = ((table.xyz[cands] - block[ambiguous][:, np.newaxis, :]) ** 2).sum(axis=2)
+            best[ambiguous] = cands[np.arange(len(ambiguous)), chords.argmin(axis=1)]
+
+        indices[start:start + len(block)] = best
+
+    lat2 = table.lat[indices]
+    a = (1 - np.cos(lat2 - xyz1.lat)
+         + xyz1.cos_lat * table.cos_lat[indices] * (1 - np.cos(table.lon[indices] - xyz1.lon)))
+    distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a / 2, 0.0, 1.0)))
+
+    return indices, distances
+
+
+# reference set and matcher of a gps_match worker process, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(name, shape, backend):
+    """Attach a worker process to the reference set in shared memory"""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    reference = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+    # keep shm referenced so the buffer stays mapped
+    _worker_state["shm"] = shm
+    _worker_state["match"] = _matcher(reference, backend)
+
+
+def _match_chunk(points):
+    """Match a chunk of locations1 inside a worker process"""
+    return _worker_state["match"](points)
+
+
+def _match_parallel(locations1, locations2, backend, workers):
+    """
+    Split locations1 into chunks and match them in a pool of worker processes
+
+    locations2 is copied once into shared memory, which every worker maps
+    instead of receiving its own pickled copy. Results are returned in the
+    order of locations1.
+    """
+    # only loaded by callers that ask for workers
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+
+    points2 = np.asarray(locations2, dtype=np.float64)
+    points1 = np.asarray(locations1, dtype=np.float64)
+    chunks = np.array_split(points1, min(len(points1), workers * CHUNKS_PER_WORKER))
+
+    shm = shared_memory.SharedMemory(create=True, size=points2.nbytes)
+    try:
+        np.ndarray(points2.shape, dtype=np.float64, buffer=shm.buf)[:] = points2
+
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(shm.name, points2.shape, backend)) as pool:
+            # map yields results in submission order
+            results = list(pool.map(_match_chunk, chunks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+    indices = np.concatenate([chunk_indices for chunk_indices, _ in results]).astype(np.intp)
+    distances = np.concatenate([chunk_distances for _, chunk_distances in results]).astype(np.float64)
+    return indices, distances
+
+
+class MatchStats:
+    """
+    Counters and timing for a single gps_match call
+
+    evaluations is the number of point-to-point distances computed while
+    searching, and pruned the number of candidate pairs skipped without
+    one, e.g. by the k-d tree or by a DistanceCache hit; both are None when
+    they are not known (tree backends run in worker processes). phases maps
+    "validation", "index" and "search" to the seconds spent in each.
+    """
+
+    def __init__(self, backend, points, references, elapsed, evaluations=None, pruned=None, phases=None):
+        self.backend = backend
+        self.points = points
+        self.references = references
+        self.elapsed = elapsed
+        self.evaluations = evaluations
+        self.pruned = pruned
+        self.phases = phases if phases is not None else {}
+
+    def __repr__(self):
+        return (f"MatchStats(backend={self.backend!r}, points={self.points}, "
+                f"references={self.references}, elapsed={self.elapsed:.6f}, "
+                f"evaluations={self.evaluations}, pruned={self.pruned}, phases={self.phases})")
+
+
+class Instrumentation:
+    """
+    Aggregate statistics over gps_match calls
+
+    Created by enable_instrumentation(). With a sample_rate of N, every Nth
+    match of each call is also logged at DEBUG level. If a sink is given,
+    it is called with the MatchStats of every call.
+    """
+
+    def __init__(self, sample_rate=0, sink=None):
+        self.sample_rate = sample_rate
+        self.sink = sink
+        self.calls = 0
+        self.points = 0
+        self.evaluations = 0
+        self.pruned = 0
+        self.elapsed = 0.0
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.last = None
+        # backend -> [calls, points, evaluations, pruned]
+        self._backends = {}
+
+    def record(self, stats, matches):
+        self.calls += 1
+        self.points += stats.points
+        self.evaluations += stats.evaluations or 0
+        self.pruned += stats.pruned or 0
+        self.elapsed += stats.elapsed
+        for phase, seconds in stats.phases.items():
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self.last = stats
+
+        totals = self._backends.setdefault(stats.backend, [0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += stats.points
+        totals[2] += stats.evaluations or 0
+        totals[3] += stats.pruned or 0
+
+        logger.debug("Matched %d points against %d with %s backend in %.6fs",
+                     stats.points, stats.references, stats.backend, stats.elapsed)
+
+        if self.sample_rate and logger.isEnabledFor(logging.DEBUG):
+            for match in itertools.islice(matches, None, None, self.sample_rate):
+                logger.debug("Match found: %s -> %s (%.3f km)", *match)
+
+        if self.sink is not None:
+            try:
+                self.sink(stats)
+            except Exception:
+                # a broken metrics sink should not break matching
+                logger.exception("Instrumentation sink failed")
+
+    def prometheus(self):
+        """
+        The aggregated statistics in the Prometheus text exposition format
+
+        Returns:
+            String of gps_match_* counters, per backend or per phase
+        """
+        lines = []
+        counters = [
+            ("gps_match_calls_total", "gps_match calls", 0),
+            ("gps_match_points_total", "Points matched", 1),
+            ("gps_match_distance_evaluations_total", "Distances computed while searching", 2),
+            ("gps_match_pruned_candidates_total", "Candidate pairs skipped without computing a distance", 3),
+        ]
+        for name, help_text, column in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for backend, totals in sorted(self._backends.items()):
+                lines.append(f'{name}{{backend="{backend}"}} {totals[column]}')
+
+        lines.append("# HELP gps_match_phase_seconds_total Time spent in each phase of gps_match")
+        lines.append("# TYPE gps_match_phase_seconds_total counter")
+        for phase, seconds in self.phases.items():
+            lines.append(f'gps_match_phase_seconds_total{{phase="{phase}"}} {seconds:.9f}')
+
+        return "\n".join(lines) + "\n"
+
+
+# set by enable_instrumentation(); gps_match records nothing while it is None
+_instrumentation = None
+
+
+def enable_instrumentation(sample_rate=0, sink=None):
+    """
+    Start recording statistics for every gps_match call
+
+    Args:
+        sample_rate: log every sample_rate-th match at DEBUG level, 0 for none
+        sink: function called with the MatchStats of every call, e.g. to
+            forward them to a metrics system
+
+    Returns:
+        The Instrumentation object the statistics are recorded on
+    """
+    global _instrumentation
+    _instrumentation = Instrumentation(sample_rate, sink)
+    return _instrumentation
+
+
+def disable_instrumentation():
+    """Stop recording statistics for gps_match calls"""
+    global _instrumentation
+    _instrumentation = None
+
+
+def _match_cached(locations1, reference, match, cache):
+    """
+    Match locations1 through a DistanceCache, calling match only for the
+    points that are not cached yet
+
+    reference is the fingerprint of locations2 from cache.reference():
+    matches are only reusable against the same (rounded) locations2.
+    """
+    indices = [0] * len(locations1)
+    distances = [0.0] * len(locations1)
+    missed = []
+    for i, point1 in enumerate(locations1):
+        key = (reference, cache.key(point1[0], point1[1]))
+        found = cache.get(key)
+        if found is None:
+            missed.append((i, key))
+        else:
+            indices[i], distances[i] = found
+
+    if missed:
+        missed_indices, missed_distances = match([locations1[i] for i, _ in missed])
+        for (i, key), index, distance in zip(missed, _tolist(missed_indices), _tolist(missed_distances)):
+            indices[i] = index
+            distances[i] = distance
+            cache.put(key, (index, distance))
+
+    return indices, distances
+
+
+def _choose_backend(backend, count1, count2, reused=False):
+    """
+    Check the requested backend, or pick one for count1 points against count2
+
+    reused means the index is built once for many calls of count1 points,
+    so its build cost is left out.
+    """
+    if backend is None:
+        build_cost = 0 if reused else KDTREE_BUILD_COST * count2
+        if count1 * count2 > build_cost + KDTREE_QUERY_COST * count1:
+            return "kdtree"
+        if count1 * count2 >= VECTORIZE_THRESHOLD:
+            return "numpy"
+        return "python"
+
+    if backend not in BACKENDS:
+        logger.error(f"Unknown backend: {backend}")
+        raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+    return backend
+
+
+def _resolve_backend(backend, accuracy, count1, count2, reused=False):
+    """Backend to use for the requested accuracy, see _choose_backend"""
+    if accuracy == "fast":
+        if backend not in (None, "numpy"):
+            raise ValueError(f'accuracy="fast" is only available with the numpy backend, got {backend!r}')
+        return FAST_BACKEND
+    if accuracy != "exact":
+        raise ValueError(f"accuracy must be one of {ACCURACIES}, got {accuracy!r}")
+    return _choose_backend(backend, count1, count2, reused)
+
+
+def _matcher(locations2, backend):
+    """
+    Prepare locations2 for matching with a backend
+
+    Returns:
+        Function taking locations1 and returning (indices, distances)
+    """
+    if backend == "python":
+        table = _ReferenceTable(locations2)
+        return lambda locations1: _match_python(locations1, table)
+    if backend == "numpy":
+        table = _ReferenceTable(locations2)
+        return lambda locations1: _match_numpy(locations1, table)
+    if backend == FAST_BACKEND:
+        table = _ReferenceTable(locations2)
+        return lambda locations1: _match_fast(locations1, table)
+    if backend == "geohash":
+        return GeohashIndex(locations2).query_many
+    return SphereKDTree(locations2).query_many
+
+
+def gps_match(locations1, locations2, backend=None, workers=None, columnar=False, cache=None,
+              accuracy="exact"):
     """
     Matches each GPS location of the first array with the closest of the second
 
     Args:
         locations1: list of GPS locations
         locations2: list of GPS locations
+        backend: "python", "numpy", "kdtree" or "geohash"; by default "kdtree" is used
+            once building and querying it is estimated to be cheaper than
+            comparing every pair (see KDTREE_BUILD_COST), otherwise "numpy"
+            is used once there are VECTORIZE_THRESHOLD pairs to compare
+        workers: number of processes to split locations1 across; by default
+            everything runs in the calling process
+        columnar: return a MatchResult of index and distance arrays instead
+        cache: DistanceCache remembering the match of each point; points
+            already matched against the same locations2 are looked up
+            instead of matched again
+        accuracy: "exact", or "fast" to rank candidates in float32 with the
+            NumPy backend; see _match_fast for the worst-case error
 
     Returns:
         List of lists (point from locations1, closest point in locadtions2, distance)
     """
 
-    logger.info("Starting GPS location matching")
+    logger.debug("Starting GPS location matching")
+    start = time.perf_counter()
 
     validate_coordinates(locations1, "locations1")
-    validate_coordinates(locations2, "locations2")
+    # a read-only reference set the cache remembers was validated when first seen
+    if cache is None or not cache.remembers(locations2):
+        validate_coordinates(locations2, "locations2")
+    reference = cache.reference(locations2) if cache is not None else None
 
-    out = []
+    backend = _resolve_backend(backend, accuracy, len(locations1), len(locations2))
+    validated = time.perf_counter()
 
-    for point1 in locations1:
-        # calculate distances between point1 and all points in locations2
-        distances = [haversine(point1[0], point1[1], point2[0], point2[1]) for point2 in locations2]
+    parallel = workers is not None and workers > 1
+    # built on first use, so that a call answered from the cache builds nothing
+    matcher = None
+    build_time = 0.0
 
-        # find the minimum distance
-        min_distance = min(distances)
+    def match(points):
+        nonlocal matcher, build_time
+        if matcher is None:
+            build_start = time.perf_counter()
+            if parallel:
+                # each worker builds its own index, so that is timed as search
+                matcher = lambda points: _match_parallel(points, locations2, backend, workers)
+            else:
+                matcher = _matcher(locations2, backend)
+            build_time = time.perf_counter() - build_start
+        return matcher(points)
 
-        # find the index of the minimum distance
-        index = distances.index(min_distance)
+    if cache is not None:
+        misses = cache.misses
+        indices, distances = _match_cached(locations1, reference, match, cache)
+        searched = cache.misses - misses
+    else:
+        indices, distances = match(locations1)
+        searched = len(locations1)
 
+    if columnar:
+        out = MatchResult(np.arange(len(locations1)), indices, distances)
+    else:
         # add the two points and the distance to the result
-        out.append([point1, locations2[index], min_distance])
+        indices, distances = _tolist(indices), _tolist(distances)
+        out = [[point1, locations2[index], distance] for point1, index, distance in zip(locations1, indices, distances)]
+
+    if _instrumentation is not None:
+        end = time.perf_counter()
+        candidates = len(locations1) * len(locations2)
+        if matcher is None:
+            evaluations = 0
+        elif backend in ("kdtree", "geohash"):
+            # the matcher is the query_many method of a fresh index
+            evaluations = None if parallel else matcher.__self__.evaluations
+        else:
+            evaluations = searched * len(locations2)
+        pruned = None if evaluations is None else candidates - evaluations
+        phases = {"validation": validated - start, "index": build_time,
+                  "search": end - validated - build_time}
+        stats = MatchStats(backend, len(locations1), len(locations2), end - start, evaluations, pruned, phases)
+        _instrumentation.record(stats, out)
+
+    return out
+
+
+def gps_match_trajectory(locations1, locations2):
+    """
+    Matches each GPS location of an ordered trace with the closest of a second array
+
+    Same result as gps_match with the "kdtree" backend, but every search
+    starts from the previous point's match and works outward, which skips
+    most of the tree when consecutive points are near each other.
+
+    Args:
+        locations1: list of GPS locations, in trace order
+        locations2: list of GPS locations
+
+    Returns:
+        List of lists (point from locations1, closest point in locations2, distance)
+    """
+
+    validate_coordinates(locations1, "locations1")
+    indices, distances = SphereKDTree(locations2).query_trajectory(locations1)
+    return [[point1, locations2[index], distance] for point1, index, distance in zip(locations1, indices, distances)]
+
+
+def gps_match_k(locations1, locations2, k):
+    """
+    Matches each GPS location of the first array with the k closest of the second
+
+    Args:
+        locations1: list of GPS locations
+        locations2: list of GPS locations
+        k: number of matches per location
+
+    Returns:
+        List of lists (point from locations1, list of the k closest points in
+        locations2, list of their distances), closest first
+    """
+
+    validate_coordinates(locations1, "locations1")
+    tree = SphereKDTree(locations2)
+
+    out = []
+    for point1 in locations1:
+        matches = tree.query_k(point1[0], point1[1], k)
+        out.append([point1, [locations2[index] for index, _ in matches], [distance for _, distance in matches]])
+    return out
+
+
+def gps_match_radius(locations1, locations2, km):
+    """
+    Matches each GPS location of the first array with every location of the
+    second within km of it
+
+    Args:
+        locations1: list of GPS locations
+        locations2: list of GPS locations
+        km: search radius in km
 
-        logger.info(f"Match found")
+    Returns:
+        List of lists (point from locations1, list of points in locations2
+        within km, list of their distances), closest first
+    """
 
+    validate_coordinates(locations1, "locations1")
+    if km < 0:
+        raise ValueError(f"km must not be negative, got {km}")
+    tree = SphereKDTree(locations2)
 
+    out = []
+    for point1 in locations1:
+        matches = tree.query_radius(point1[0], point1[1], km)
+        out.append([point1, [locations2[index] for index, _ in matches], [distance for _, distance in matches]])
     return out
 
 
+def read_locations_csv(path, lat_column=0, lon_column=1, header=False):
+    """
+    Lazily read GPS locations from a CSV file
+
+    Args:
+        path: path of the CSV file
+        lat_column: index or, with header, name of the latitude column
+        lon_column: index or, with header, name of the longitude column
+        header: whether the first row holds column names
+
+    Yields:
+        (lat, lon) tuples
+    """
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        if header:
+            names = next(reader, [])
+            if isinstance(lat_column, str):
+                lat_column = names.index(lat_column)
+            if isinstance(lon_column, str):
+                lon_column = names.index(lon_column)
+
+        for row in reader:
+            if row:
+                yield (float(row[lat_column]), float(row[lon_column]))
+
+
+def read_locations_ndjson(path, lat_key="lat", lon_key="lon"):
+    """
+    Lazily read GPS locations from a newline-delimited JSON file
+
+    Each line is either a [lat, lon] array or an object with lat_key and
+    lon_key fields.
+
+    Yields:
+        (lat, lon) tuples
+    """
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                yield (record[lat_key], record[lon_key])
+            else:
+                yield tuple(record)
+
+
+def prepare_matcher(locations2, backend=None, batch_size=STREAM_BATCH_SIZE, accuracy="exact", tree=None):
+    """
+    Validate and index a reference set once for matching many batches against it
+
+    Args:
+        locations2: list of GPS locations
+        backend: as for gps_match, chosen assuming batches of batch_size
+        batch_size: typical number of locations per batch
+        accuracy: as for gps_match
+        tree: SphereKDTree already built over locations2, e.g. by
+            open_reference_tree(); it is used as is, with no validation,
+            and backend and accuracy are ignored
+
+    Returns:
+        Function taking a list of already validated GPS locations and
+        returning a MatchResult against locations2
+    """
+    if tree is not None:
+        match = tree.query_many
+    else:
+        validate_coordinates(locations2, "locations2")
+        match = _matcher(locations2, _resolve_backend(backend, accuracy, batch_size, len(locations2), reused=True))
+
+    def match_batch(locations1):
+        indices, distances = match(locations1)
+        return MatchResult(np.arange(len(locations1)), indices, distances)
+
+    return match_batch
 
 
+def gps_match_stream(locations1, locations2, batch_size=STREAM_BATCH_SIZE, backend=None):
+    """
+    Matches GPS locations from any iterable with the closest of a second array,
+    holding at most batch_size of them in memory at a time
+
+    Args:
+        locations1: iterable of GPS locations, e.g. read_locations_csv(path)
+        locations2: list of GPS locations
+        batch_size: number of locations read, validated and matched at a time
+        backend: as for gps_match, chosen assuming batches of batch_size
+
+    Yields:
+        Lists (point from locations1, closest point in locations2, distance)
+    """
+
+    match = prepare_matcher(locations2, backend, batch_size)
+
+    iterator = iter(locations1)
+    offset = 0
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+
+        validate_coordinates(batch, f"locations1[{offset}:{offset + len(batch)}]")
+        for point1, (_, index, distance) in zip(batch, match(batch)):
+            yield [point1, locations2[index], distance]
+        offset += len(batch)
+
+
+def save_reference(path, locations, index=True, leaf_size=SphereKDTree.LEAF_SIZE):
+    """
+    Write a reference set to a binary file that open_reference() can map
+
+    Layout, little-endian: a 64-byte header (magic, version, flags, point
+    count, k-d tree leaf size), the latitudes and then the longitudes as
+    float64 columns, and, if index is set, the SphereKDTree point order as
+    int64, the x, y and z columns of the unit vectors in that order as
+    float64, and the split axes as int8.
+
+    Args:
+        path: file to write
+        locations: list of GPS locations
+        index: also store a prebuilt SphereKDTree
+        leaf_size: leaf size of the stored tree
+    """
+    validate_coordinates(locations, "locations")
+    table = _ReferenceTable(locations)
+
+    flags = REFERENCE_HAS_INDEX if index else 0
+    with open(path, "wb") as f:
+        f.write(REFERENCE_HEADER.pack(REFERENCE_MAGIC, REFERENCE_VERSION, flags, len(table), leaf_size))
+        f.write(np.ascontiguousarray(table.lats, dtype="<f8").tobytes())
+        f.write(np.ascontiguousarray(table.lons, dtype="<f8").tobytes())
+        if index:
+            perm, axes = SphereKDTree._build(table.xyz, leaf_size)
+            f.write(perm.astype("<i8").tobytes())
+            xyz = table.xyz[perm]
+            for axis in range(3):
+                f.write(np.ascontiguousarray(xyz[:, axis], dtype="<f8").tobytes())
+            f.write(axes.astype(np.int8).tobytes())
+
+
+def _read_reference_header(path):
+    with open(path, "rb") as f:
+        header = f.read(REFERENCE_HEADER.size)
+    if len(header) < REFERENCE_HEADER.size:
+        raise ValueError(f"{path} is not a GPS reference file")
+
+    magic, version, flags, count, leaf_size = REFERENCE_HEADER.unpack(header)
+    if magic != REFERENCE_MAGIC:
+        raise ValueError(f"{path} is not a GPS reference file")
+    if version != REFERENCE_VERSION:
+        raise ValueError(f"{path} has unsupported version {version}")
+    return flags, count, leaf_size
+
+
+def open_reference(path):
+    """
+    Map a file written by save_reference() without reading it into memory
+
+    The pages are shared by every process that opens the same file.
+
+    Returns:
+        Read-only CoordinateArray backed by the file
+    """
+    _, count, _ = _read_reference_header(path)
+    lats = np.memmap(path, dtype="<f8", mode="r", offset=REFERENCE_HEADER.size, shape=(count,))
+    lons = np.memmap(path, dtype="<f8", mode="r", offset=REFERENCE_HEADER.size + 8 * count, shape=(count,))
+    return CoordinateArray(lats, lons)
+
+
+def open_reference_tree(path):
+    """
+    Load the SphereKDTree stored by save_reference(..., index=True),
+    without rebuilding it
+
+    Returns:
+        (CoordinateArray backed by the file, SphereKDTree over it)
+    """
+    flags, count, leaf_size = _read_reference_header(path)
+    if not flags & REFERENCE_HAS_INDEX:
+        raise ValueError(f"{path} has no stored index")
 
+    locations = open_reference(path)
+    offset = REFERENCE_HEADER.size + 16 * count
+    perm = np.memmap(path, dtype="<i8", mode="r", offset=offset, shape=(count,))
+    coords = [np.memmap(path, dtype="<f8", mode="r", offset=offset + 8 * (axis + 1) * count, shape=(count,))
+              for axis in range(3)]
+    axes = np.memmap(path, dtype=np.int8, mode="r", offset=offset + 32 * count, shape=(count,))
+    return locations, SphereKDTree(locations, leaf_size, _layout=(perm, axes, coords))
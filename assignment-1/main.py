@@ -1,6 +1,8 @@
 import gps
 
 def main():
+    gps.configure_logging()
+
     locations1 = [(40.7128, -74.0060), (34.0522, -118.2437)]
     locations2 = [(37.7749, -122.4194), (45.7128, -74.0060), (34.0522, -118.2437)]
 
@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+
+import gps
+
+logger = logging.getLogger(__name__)
+
+# how long the service waits for more requests before matching a batch
+BATCH_WINDOW = 0.002
+
+# largest number of points matched in one batch
+MAX_BATCH = 10_000
+
+
+class MatchService:
+    """
+    Serves nearest-point queries against a resident reference set
+
+    Requests that arrive within batch_window seconds of each other are
+    matched together in one vectorized batch, and each gets its own reply.
+
+    Protocol: one JSON object per line in each direction. A request is
+    {"id": ..., "lat": ..., "lon": ...}; the reply is
+    {"id": ..., "index": ..., "point": [lat, lon], "distance": km}, or
+    {"id": ..., "error": message} for an invalid request. Replies on a
+    connection may come back in a different order than the requests.
+
+    A prebuilt tree over locations, e.g. from gps.open_reference_tree, is
+    used instead of indexing them again. Call close() once the server is
+    closed to stop the background batching task.
+    """
+
+    def __init__(self, locations, backend=None, batch_window=BATCH_WINDOW, max_batch=MAX_BATCH, tree=None):
+        self.locations = locations
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.batches = 0
+        self._match = gps.prepare_matcher(locations, backend, max_batch, tree=tree)
+        self._queue = asyncio.Queue()
+        self._batcher = None
+
+    async def match(self, lat, lon):
+        """
+        Find the closest reference point, batched with concurrent calls
+
+        Returns:
+            (index of the closest reference point, distance in km)
+        """
+        gps.validate_coordinates([(lat, lon)], "point")
+
+        if self._batcher is None:
+            self._batcher = asyncio.create_task(self._run_batches())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(((lat, lon), future))
+        return await future
+
+    async def close(self):
+        """Stop matching; requests still waiting for a batch are cancelled"""
+        if self._batcher is not None:
+            self._batcher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._batcher
+            self._batcher = None
+
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch = [await self._queue.get()]
+
+                # collect whatever else arrives within the window
+                deadline = loop.time() + self.batch_window
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                points = [point for point, _ in batch]
+                try:
+                    # off the event loop, so connections keep being served
+                    result = await loop.run_in_executor(None, self._match, points)
+                except Exception as e:
+                    logger.exception("Batch of %d points failed", len(batch))
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                self.batches += 1
+                for (_, future), (_, index, distance) in zip(batch, result):
+                    if not future.done():
+                        future.set_result((index, distance))
+        except asyncio.CancelledError:
+            # the batch being collected or matched when close() was called
+            for _, future in batch:
+                future.cancel()
+            raise
+
+    async def _reply(self, request, writer):
+        try:
+            index, distance = await self.match(request["lat"], request["lon"])
+            reply = {"id": request.get("id"), "index": index,
+                     "point": list(self.locations[index]), "distance": distance}
+        except (KeyError, TypeError, ValueError) as e:
+            reply = {"id": request.get("id"), "error": str(e)}
+
+        if writer.is_closing():
+            return
+        try:
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        except (ConnectionError, OSError) as e:
+            logger.debug("Client went away before its reply: %r", e)
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests from one client until it disconnects"""
+        pending = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, OSError):
+                    break
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                except ValueError as e:
+                    writer.write(json.dumps({"id": None, "error": str(e)}).encode() + b"\n")
+                    continue
+
+                # reply as soon as this request's batch is matched
+                task = asyncio.create_task(self._reply(request, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            # requests cancelled by close() have no reply to wait for
+            await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError, OSError):
+                await writer.wait_closed()
+
+    async def start(self, host="127.0.0.1", port=8765, path=None):
+        """Start listening on a TCP port, or on a Unix socket if path is given"""
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def serve(locations, host, port, path, backend, batch_window, tree=None):
+    service = MatchService(locations, backend, batch_window, tree=tree)
+    server = await service.start(host, port, path)
+    logger.info("Serving %d reference points on %s", len(locations), path or f"{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPS nearest-point matching service")
+    parser.add_argument("reference", help="CSV file of reference points (lat,lon per row), "
+                                          "or a .gpsref file written by gps.save_reference")
+    parser.add_argument("--header", action="store_true", help="the CSV file has a header row")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--backend", choices=gps.BACKENDS)
+    parser.add_argument("--window", type=float, default=BATCH_WINDOW * 1000,
+                        help="batching window in milliseconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tree = None
+    if args.reference.endswith(".gpsref"):
+        locations = None
+        if args.backend in (None, "kdtree"):
+            # a stored tree saves indexing the reference set again
+            try:
+                locations, tree = gps.open_reference_tree(args.reference)
+            except ValueError:
+                pass
+        if locations is None:
+            locations = gps.open_reference(args.reference)
+    else:
+        locations = list(gps.read_locations_csv(args.reference, header=args.header))
+    asyncio.run(serve(locations, args.host, args.port, args.unix, args.backend, args.window / 1000, tree))
+
+
+if __name__ == "__main__":
+    main()
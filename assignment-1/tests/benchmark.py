@@ -0,0 +1,162 @@
+import sys
+sys.path.insert(0, '.')
+
+import argparse
+import json
+import math
+import platform
+import random
+import time
+import tracemalloc
+
+import numpy as np
+
+import gps
+
+# sizes swept for both locations1 and locations2
+SIZES = [10, 100, 1_000, 10_000, 100_000, 1_000_000]
+
+# largest N * M each brute-force backend is run for
+MAX_PAIRS = {
+    "python": 10 ** 6,
+    "numpy": 10 ** 8,
+    gps.FAST_BACKEND: 10 ** 8,
+}
+
+# largest N or M each index backend is run for; their pure-Python searches
+# cost a few microseconds per query whatever M is, so N = 10^6 alone takes
+# about 20 s
+MAX_POINTS = {
+    "kdtree": 10 ** 5,
+    "geohash": 10 ** 5,
+}
+
+# largest N or M the tracemalloc run is done for; tracing slows the
+# pure-Python searches about fifteenfold
+MEMORY_MAX_POINTS = 10 ** 4
+
+# every backend, plus the NumPy backend with accuracy="fast"
+BACKENDS = list(gps.BACKENDS) + [gps.FAST_BACKEND]
+
+
+def match(backend, locations1, locations2):
+    if backend == gps.FAST_BACKEND:
+        return gps.gps_match(locations1, locations2, accuracy="fast")
+    return gps.gps_match(locations1, locations2, backend=backend)
+
+
+def random_locations(count, seed):
+    """Uniformly spread points on the sphere"""
+    rng = random.Random(seed)
+    return [(math.degrees(math.asin(rng.uniform(-1, 1))), rng.uniform(-180, 180)) for _ in range(count)]
+
+
+def run_case(backend, locations1, locations2, repeat, memory):
+    """Time one backend on one input, and optionally measure its peak memory"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        match(backend, locations1, locations2)
+        best = min(best, time.perf_counter() - start)
+
+    result = {
+        "backend": backend,
+        "n": len(locations1),
+        "m": len(locations2),
+        "seconds": best,
+        "points_per_second": len(locations1) / best,
+    }
+
+    if memory:
+        tracemalloc.start()
+        match(backend, locations1, locations2)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mb"] = peak / 10 ** 6
+
+    return result
+
+
+def run(sizes, backends, repeat=1, memory=True, max_pairs=MAX_PAIRS, max_points=MAX_POINTS):
+    """Run every backend on every (N, M) pair of sizes within its caps and return the report"""
+    results = []
+    skipped = []
+
+    for m in sizes:
+        locations2 = random_locations(m, seed=m)
+        for n in sizes:
+            locations1 = random_locations(n, seed=n + 1)
+            for backend in backends:
+                if (n * m > max_pairs.get(backend, float("inf"))
+                        or max(n, m) > max_points.get(backend, float("inf"))):
+                    skipped.append({"backend": backend, "n": n, "m": m})
+                    continue
+
+                traced = memory and max(n, m) <= MEMORY_MAX_POINTS
+                result = run_case(backend, locations1, locations2, repeat, traced)
+                results.append(result)
+                print(f"{backend:>8} N={n:<8} M={m:<8} {result['seconds']:.4f}s"
+                      + (f" {result['peak_mb']:.1f}MB" if traced else ""), file=sys.stderr)
+
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """List the cases that got more than tolerance times slower than in baseline"""
+    previous = {(r["backend"], r["n"], r["m"]): r["seconds"] for r in baseline["results"]}
+
+    regressions = []
+    for result in report["results"]:
+        before = previous.get((result["backend"], result["n"], result["m"]))
+        if before and result["seconds"] > before * tolerance:
+            regressions.append({**result, "baseline_seconds": before, "ratio": result["seconds"] / before})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gps_match backends")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=SIZES,
+                        help="comma-separated sizes swept for N and M")
+    parser.add_argument("--backends", type=lambda s: s.split(","), default=BACKENDS,
+                        help="comma-separated backends to compare")
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per case, best is kept")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc run, otherwise done up to MEMORY_MAX_POINTS")
+    parser.add_argument("--max-points", type=int,
+                        help="largest N or M for the index backends, instead of MAX_POINTS")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="slowdown relative to the baseline reported as a regression")
+    args = parser.parse_args()
+
+    max_points = MAX_POINTS
+    if args.max_points:
+        max_points = dict.fromkeys(MAX_POINTS, args.max_points)
+    report = run(args.sizes, args.backends, args.repeat, not args.no_memory, max_points=max_points)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r['backend']} N={r['n']} M={r['m']}: "
+                  f"{r['baseline_seconds']:.4f}s -> {r['seconds']:.4f}s ({r['ratio']:.2f}x)", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 import sys
 sys.path.insert(0, '.')
+import json
+import os
+import random
+import subprocess
+
+import numpy as np
 import pytest
 
 # import importlib  
@@ -7,6 +13,11 @@ import pytest
 
 import gps
 
+
+def random_locations(rng, count):
+    """count points spread uniformly in latitude and longitude, drawn from rng"""
+    return [[rng.uniform(-90, 90), rng.uniform(-180, 180)] for _ in range(count)]
+
 def test_valid_coordinates():
     locations1 = [[42.3601, -71.0589], [40.7128, -74.0060]]  # Boston, NYC
     locations2 = [[42.3601, -71.0589], [41.8781, -87.6298]]  # Boston, Chicago
@@ -72,10 +83,466 @@ def test_closest_match():
     assert result[0][1] == locations[2]  # Should match with Boston
     assert result[0][2] == 0  # Distance should be 0
 
-# def false():
-#     assert(False)
+def test_numpy_backend_matches_python():
+    locations1 = [[42.3601, -71.0589], [40.7128, -74.0060], [-33.8688, 151.2093]]
+    locations2 = [[41.8781, -87.6298], [42.3601, -71.0589], [35.6762, 139.6503]]
+    expected = gps.gps_match(locations1, locations2, backend="python")
+    result = gps.gps_match(locations1, locations2, backend="numpy")
+    for got, want in zip(result, expected):
+        assert got[0] is want[0]
+        assert got[1] is want[1]
+        assert got[2] == pytest.approx(want[2])
+
+def test_numpy_backend_chunks():
+    locations1 = [[lat, lat / 2] for lat in range(-80, 81, 4)]
+    locations2 = [[lat + 1, lat / 2 + 1] for lat in range(-80, 81, 4)]
+    indices, distances = gps._match_numpy(locations1, locations2, chunk_size=len(locations2) * 3)
+    assert indices.tolist() == list(range(len(locations1)))
+    assert distances == pytest.approx(gps._match_python(locations1, locations2)[1])
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        gps.gps_match([[0, 0]], [[0, 0]], backend="fortran")
+
+def test_kdtree_matches_brute_force():
+    rng = random.Random(2)
+    locations1 = random_locations(rng, 200)
+    locations2 = random_locations(rng, 500)
+    expected = gps.gps_match(locations1, locations2, backend="numpy")
+    result = gps.gps_match(locations1, locations2, backend="kdtree")
+    for got, want in zip(result, expected):
+        assert got[1] is want[1]
+        assert got[2] == pytest.approx(want[2])
+
+def test_kdtree_query():
+    tree = gps.SphereKDTree([[40.7128, -74.0060], [41.8781, -87.6298], [42.3601, -71.0589]])
+    assert len(tree) == 3
+    assert tree.query(42.3601, -71.0589) == (2, 0)
+    # across the antimeridian
+    tree = gps.SphereKDTree([[0, 179.9], [0, 170]])
+    assert tree.query(0, -179.9)[0] == 0
+
+def test_gps_index_queries():
+    boston, nyc, chicago = [42.3601, -71.0589], [40.7128, -74.0060], [41.8781, -87.6298]
+    index = gps.GPSIndex([boston, chicago])
+    key, distance = index.nearest(nyc)
+    assert index[key] == boston
+    assert 300 < distance < 310
+    assert index.nearest_many([boston, chicago]) == ([0, 1], [0, 0])
+    assert [key for key, _ in index.within_radius(nyc, 1500)] == [0, 1]
+    assert index.within_radius(nyc, 100) == []
+
+def test_gps_index_add_remove():
+    rng = random.Random(3)
+    points = random_locations(rng, 300)
+    index = gps.GPSIndex(points[:100])
+    for point in points[100:]:
+        index.add(point)
+    for key in range(0, 300, 3):
+        index.remove(key)
+    with pytest.raises(KeyError):
+        index.remove(0)
+
+    remaining = [key for key in range(300) if key % 3]
+    assert len(index) == len(remaining)
+    queries = random_locations(rng, 50)
+    keys, distances = index.nearest_many(queries)
+    expected = gps.gps_match(queries, [points[key] for key in remaining], backend="numpy")
+    for key, distance, match in zip(keys, distances, expected):
+        assert points[key] is match[1]
+        assert distance == pytest.approx(match[2])
+
+    for key in remaining:
+        index.remove(key)
+    with pytest.raises(ValueError):
+        index.nearest([0, 0])
+
+def test_gps_match_k():
+    rng = random.Random(4)
+    locations1 = random_locations(rng, 20)
+    locations2 = random_locations(rng, 300)
+    result = gps.gps_match_k(locations1, locations2, 5)
+    for point1, points2, distances in result:
+        expected = sorted(gps.haversine(point1[0], point1[1], lat, lon) for lat, lon in locations2)[:5]
+        assert distances == pytest.approx(expected)
+        assert len(points2) == 5
+    assert len(gps.gps_match_k([[0, 0]], [[0, 1], [0, 2]], 5)[0][1]) == 2
+    with pytest.raises(ValueError):
+        gps.gps_match_k([[0, 0]], [[0, 1]], 0)
+
+def test_gps_match_radius():
+    ny = [40.7128, -74.0060]
+    locations = [[41.8781, -87.6298], [42.3601, -71.0589], [40.7128, -74.0060]]
+    result = gps.gps_match_radius([ny], locations, 400)
+    assert result[0][1] == [locations[2], locations[1]]
+    assert result[0][2][0] == 0
+    assert 300 < result[0][2][1] < 310
+    assert gps.gps_match_radius([[0, 0]], [[10, 10]], 100)[0][1] == []
+
+def test_instrumentation(caplog):
+    stats = gps.enable_instrumentation(sample_rate=2)
+    try:
+        with caplog.at_level("DEBUG", logger="gps"):
+            gps.gps_match([[0, 0], [1, 1], [2, 2]], [[0, 0]], backend="python")
+            gps.gps_match([[0, 0]], [[0, 0], [1, 1]], backend="numpy")
+    finally:
+        gps.disable_instrumentation()
+
+    assert stats.calls == 2
+    assert stats.points == 4
+    assert stats.last.backend == "numpy"
+    assert stats.last.references == 2
+    assert stats.elapsed > 0
+    assert len([r for r in caplog.records if r.getMessage().startswith("Match found")]) == 3
+
+    gps.gps_match([[0, 0]], [[0, 0]])
+    assert stats.calls == 2
+
+def test_haversine_does_not_log(caplog):
+    with caplog.at_level("DEBUG", logger="gps"):
+        gps.haversine(40.7, -74.0, 37.7, -122.4)
+    assert caplog.records == []
+
+def test_parallel_matches_serial():
+    rng = random.Random(5)
+    locations1 = random_locations(rng, 101)
+    locations2 = random_locations(rng, 50)
+    expected = gps.gps_match(locations1, locations2, backend="numpy")
+    for backend in gps.BACKENDS:
+        result = gps.gps_match(locations1, locations2, backend=backend, workers=2)
+        assert [match[0] for match in result] == locations1
+        for got, want in zip(result, expected):
+            assert got[1] is want[1]
+            assert got[2] == pytest.approx(want[2])
+
+def test_gps_match_stream(tmp_path):
+    rng = random.Random(6)
+    locations1 = [tuple(point) for point in random_locations(rng, 25)]
+    locations2 = random_locations(rng, 10)
+    expected = gps.gps_match(locations1, locations2, backend="python")
+
+    result = list(gps.gps_match_stream(iter(locations1), locations2, batch_size=7))
+    assert result == expected
+
+    csv_path = tmp_path / "fixes.csv"
+    csv_path.write_text("id,lat,lon\n" + "".join(f"{i},{lat!r},{lon!r}\n" for i, (lat, lon) in enumerate(locations1)))
+    fixes = gps.read_locations_csv(csv_path, "lat", "lon", header=True)
+    assert list(gps.gps_match_stream(fixes, locations2, batch_size=4)) == expected
+
+    ndjson_path = tmp_path / "fixes.ndjson"
+    ndjson_path.write_text("".join(json.dumps({"lat": lat, "lon": lon}) + "\n" for lat, lon in locations1))
+    fixes = gps.read_locations_ndjson(ndjson_path)
+    assert list(gps.gps_match_stream(fixes, locations2, backend="python")) == expected
+
+def test_gps_match_stream_invalid_point():
+    stream = gps.gps_match_stream(iter([[0, 0], [0, 0], [100, 0]]), [[0, 0]], batch_size=2)
+    assert next(stream)[2] == 0
+    with pytest.raises(ValueError, match=r"locations1\[2:3\]"):
+        list(stream)
+
+def test_validate_array():
+    points = np.zeros((100, 2))
+    gps.validate_coordinates(points)
+    result = gps.gps_match(points[:3], points, backend="numpy")
+    assert [match[2] for match in result] == [0, 0, 0]
+
+    points[42, 0] = 91
+    with pytest.raises(ValueError, match="index 42"):
+        gps.validate_coordinates(points)
+    points[42, 0] = np.nan
+    with pytest.raises(ValueError, match="latitude .* index 42"):
+        gps.validate_coordinates(points)
+
+    for bad in (np.zeros((0, 2)), np.zeros((3, 3)), np.zeros(2), np.array([["0", "0"]])):
+        with pytest.raises(ValueError):
+            gps.validate_coordinates(bad)
+
+def test_validate_long_list():
+    points = [[0, 0]] * 100
+    gps.validate_coordinates(points)
+    for bad in ([[0, 0]] * 99 + [[0, 181]], [[0, 0]] * 99 + [["0", "0"]], [[0, 0]] * 99 + [[0]]):
+        with pytest.raises(ValueError, match="index 99"):
+            gps.validate_coordinates(bad)
+
+def test_coordinate_array():
+    boston, nyc, chicago = (42.3601, -71.0589), (40.7128, -74.0060), (41.8781, -87.6298)
+    locations1 = gps.CoordinateArray.from_points([nyc, chicago])
+    locations2 = gps.CoordinateArray([boston[0], chicago[0]], [boston[1], chicago[1]])
+    assert len(locations2) == 2
+    assert locations2[1] == chicago
+    assert list(locations2) == [boston, chicago]
+    with pytest.raises(AttributeError):
+        locations2.extra = 1
+
+    expected = gps.gps_match([nyc, chicago], [boston, chicago], backend="python")
+    for backend in gps.BACKENDS:
+        result = gps.gps_match(locations1, locations2, backend=backend)
+        assert [match[1] for match in result] == [boston, chicago]
+        assert [match[2] for match in result] == pytest.approx([match[2] for match in expected])
+    assert gps.gps_match_k(locations1, locations2, 2)[1][1] == [chicago, boston]
+    assert gps.GPSIndex(locations2).nearest(nyc)[0] == 0
+
+    with pytest.raises(ValueError, match="index 1"):
+        gps.validate_coordinates(gps.CoordinateArray([0, 0], [0, 200]))
+
+def test_columnar_result():
+    locations1 = [[42.3601, -71.0589], [40.7128, -74.0060], [41.8781, -87.6298]]
+    locations2 = [[41.8781, -87.6298], [42.3601, -71.0589]]
+    for backend in gps.BACKENDS:
+        result = gps.gps_match(locations1, locations2, backend=backend, columnar=True)
+        assert len(result) == 3
+        assert result.query_index.tolist() == [0, 1, 2]
+        assert result.match_index.tolist() == [1, 1, 0]
+        assert result.to_list(locations1, locations2) == gps.gps_match(locations1, locations2, backend=backend)
+
+def test_distance_cache():
+    cache = gps.DistanceCache(maxsize=2, precision=3)
+    distance = cache.distance(40.7, -74.0, 37.7, -122.4)
+    assert distance == gps.haversine(40.7, -74.0, 37.7, -122.4)
+    assert cache.distance(37.7, -122.4, 40.70001, -74.0) == distance
+    assert cache.cache_info() == (1, 1, 2, 1)
 
+    cache.distance(0, 0, 1, 1)
+    cache.distance(0, 0, 2, 2)
+    cache.distance(40.7, -74.0, 37.7, -122.4)
+    assert cache.cache_info().misses == 4
+    assert cache.hit_rate == 0.2
 
+def test_gps_match_cache():
+    locations1 = [[42.3601, -71.0589], [40.7128, -74.0060], [42.3601, -71.0589]]
+    locations2 = [[41.8781, -87.6298], [42.3601, -71.0589]]
+    cache = gps.DistanceCache()
+    expected = gps.gps_match(locations1, locations2)
+    assert gps.gps_match(locations1, locations2, cache=cache) == expected
+    assert cache.misses == 3
+    assert gps.gps_match(locations1, locations2, cache=cache) == expected
+    assert cache.hits == 3
 
+    # a different reference set does not reuse those matches
+    result = gps.gps_match(locations1, locations2[:1], cache=cache)
+    assert [match[1] for match in result] == [locations2[0]] * 3
+    assert cache.hits == 3
 
-    
\ No newline at end of file
+def test_geohash_encode():
+    assert gps.geohash_encode(57.64911, 10.40744, 11) == "u4pruydqqvj"
+    assert gps.geohash_encode(42.3601, -71.0589, 5) == "drt2z"
+
+def test_geohash_matches_brute_force():
+    rng = random.Random(7)
+    locations1 = random_locations(rng, 200)
+    # clustered reference points, so some queries are far from every point
+    locations2 = [[rng.gauss(45, 5), rng.gauss(10, 10)] for _ in range(500)]
+    locations2 += [[89.9, 0], [-89.9, 0], [0, 179.9], [0, -179.9]]
+    expected = gps.gps_match(locations1, locations2, backend="numpy")
+    for precision in (None, 1, 3, 6):
+        index = gps.GeohashIndex(locations2, precision)
+        indices, distances = index.query_many(locations1)
+        for i, distance, want in zip(indices, distances, expected):
+            assert locations2[i] is want[1]
+            assert distance == pytest.approx(want[2])
+
+def test_reference_file(tmp_path):
+    rng = random.Random(8)
+    locations = [tuple(point) for point in random_locations(rng, 500)]
+    path = tmp_path / "depots.gpsref"
+    gps.save_reference(path, locations)
+
+    reference = gps.open_reference(path)
+    assert isinstance(reference.lats.base, np.memmap) or isinstance(reference.lats, np.memmap)
+    assert list(reference) == locations
+
+    queries = random_locations(rng, 50)
+    expected = gps.gps_match(queries, locations, backend="numpy")
+    _, tree = gps.open_reference_tree(path)
+    indices, distances = tree.query_many(queries)
+    assert [locations[i] for i in indices] == [match[1] for match in expected]
+    # the stored tree is searched in the mapped file, not copied
+    assert all(isinstance(column, memoryview) for column in tree._coords)
+    built = gps.SphereKDTree(locations)
+    assert tree.query_trajectory(queries) == built.query_trajectory(queries)
+    assert tree.query_k(10, 20, 5) == built.query_k(10, 20, 5)
+    assert tree.query_radius(10, 20, 2000) == built.query_radius(10, 20, 2000)
+    assert gps.gps_match(queries, reference, backend="numpy") == expected
+
+    gps.save_reference(path, locations, index=False)
+    assert list(gps.open_reference(path)) == locations
+    with pytest.raises(ValueError):
+        gps.open_reference_tree(path)
+
+    (tmp_path / "other").write_bytes(b"x" * 100)
+    with pytest.raises(ValueError):
+        gps.open_reference(tmp_path / "other")
+
+def test_fast_accuracy():
+    rng = random.Random(9)
+    locations1 = random_locations(rng, 300)
+    locations2 = random_locations(rng, 300)
+    # exact whenever the float32 error band holds few points
+    assert gps.gps_match(locations1, locations2, accuracy="fast") == gps.gps_match(locations1, locations2, backend="numpy")
+
+    # thousands of points within a kilometre: float32 cannot tell them apart
+    cluster = [[42.36 + rng.uniform(0, 0.01), -71.06 + rng.uniform(0, 0.01)] for _ in range(2000)]
+    queries = cluster[:200]
+    exact = gps.gps_match(queries, cluster, backend="numpy", columnar=True)
+    fast = gps.gps_match(queries, cluster, accuracy="fast", columnar=True)
+    assert (fast.distance >= exact.distance).all()
+    assert (fast.distance - exact.distance).max() <= gps.FAST_MAX_ERROR_KM
+
+    with pytest.raises(ValueError):
+        gps.gps_match(locations1, locations2, accuracy="rough")
+    with pytest.raises(ValueError):
+        gps.gps_match(locations1, locations2, backend="kdtree", accuracy="fast")
+
+def test_gps_match_trajectory():
+    rng = random.Random(17)
+    locations2 = [[rng.uniform(30, 50), rng.uniform(-120, -70)] for _ in range(5000)]
+    trace = [[40.0, -100.0]]
+    for _ in range(500):
+        lat, lon = trace[-1]
+        trace.append([lat + rng.uniform(-0.05, 0.05), lon + rng.uniform(-0.05, 0.05)])
+    assert gps.gps_match_trajectory(trace, locations2) == gps.gps_match(trace, locations2, backend="kdtree")
+
+    # jumping around gives the same matches, only without the speedup
+    scattered = random_locations(rng, 200)
+    assert gps.gps_match_trajectory(scattered, locations2) == gps.gps_match(scattered, locations2, backend="kdtree")
+
+def test_instrumentation_counters():
+    rng = random.Random(18)
+    locations1 = random_locations(rng, 50)
+    locations2 = random_locations(rng, 2000)
+
+    sunk = []
+    stats = gps.enable_instrumentation(sink=sunk.append)
+    try:
+        gps.gps_match(locations1, locations2, backend="numpy")
+        gps.gps_match(locations1, locations2, backend="kdtree")
+    finally:
+        gps.disable_instrumentation()
+
+    numpy_stats, kdtree_stats = sunk
+    assert numpy_stats.evaluations == 50 * 2000
+    assert numpy_stats.pruned == 0
+    # the tree skips most candidates
+    assert 0 < kdtree_stats.evaluations < 50 * 2000 / 10
+    assert kdtree_stats.evaluations + kdtree_stats.pruned == 50 * 2000
+    assert set(kdtree_stats.phases) == set(gps.PHASES)
+    assert sum(kdtree_stats.phases.values()) <= kdtree_stats.elapsed
+
+    assert stats.evaluations == numpy_stats.evaluations + kdtree_stats.evaluations
+    text = stats.prometheus()
+    assert 'gps_match_calls_total{backend="kdtree"} 1' in text
+    assert f'gps_match_distance_evaluations_total{{backend="numpy"}} {50 * 2000}' in text
+    assert 'gps_match_phase_seconds_total{phase="index"}' in text
+
+def test_instrumentation_broken_sink():
+    def sink(stats):
+        raise RuntimeError("sink is down")
+
+    gps.enable_instrumentation(sink=sink)
+    try:
+        assert gps.gps_match([[0, 0]], [[0, 0]])[0][2] == 0
+    finally:
+        gps.disable_instrumentation()
+
+def test_import_has_no_side_effects(tmp_path):
+    code = ("import logging, sys, gps; "
+            "assert 'numpy' not in sys.modules; "
+            "assert not logging.getLogger().handlers")
+    env = {"PYTHONPATH": os.path.dirname(os.path.abspath(gps.__file__))}
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True)
+    assert list(tmp_path.iterdir()) == []
+
+def test_distance_matrix(tmp_path):
+    rng = random.Random(20)
+    locations1 = random_locations(rng, 70)
+    locations2 = random_locations(rng, 30)
+    points1, points2 = np.array(locations1), np.array(locations2)
+    expected = gps.haversine_matrix(points1[:, 0], points1[:, 1], points2[:, 0], points2[:, 1])
+
+    # tiles of 3 rows
+    assert np.allclose(gps.distance_matrix(locations1, locations2, tile_size=100), expected)
+
+    # tiles of part of a row, never more than tile_size distances
+    class Blocks(np.ndarray):
+        def __setitem__(self, index, value):
+            assert np.size(value) <= 7
+            super().__setitem__(index, value)
+
+    out = np.zeros((70, 30)).view(Blocks)
+    gps.distance_matrix(locations1, locations2, out=out, tile_size=7)
+    assert np.allclose(out, expected)
+
+    path = tmp_path / "distances.npy"
+    result = gps.distance_matrix(locations1, locations2, out=path, dtype="float32")
+    assert isinstance(result, np.memmap)
+    stored = np.load(path, mmap_mode="r")
+    assert stored.dtype == np.float32 and stored.shape == (70, 30)
+    assert np.allclose(stored, expected, atol=1e-2)
+
+    out = np.zeros((70, 30))
+    assert gps.distance_matrix(locations1, locations2, out=out) is out
+    with pytest.raises(ValueError):
+        gps.distance_matrix(locations1, locations2, out=np.zeros((30, 70)))
+
+def test_gps_match_cache_hits_skip_reference_work(monkeypatch):
+    locations1 = [[42.3601, -71.0589], [40.7128, -74.0060]]
+    locations2 = np.array([[41.8781, -87.6298], [42.3601, -71.0589], [40.7, -74.0]] * 30)
+    locations2.flags.writeable = False
+    cache = gps.DistanceCache()
+    expected = gps.gps_match(locations1, locations2, backend="kdtree", columnar=True, cache=cache)
+
+    def no_reference_work(*args):
+        raise AssertionError("reference set touched by an all-hit call")
+
+    monkeypatch.setattr(gps, "_matcher", no_reference_work)
+    monkeypatch.setattr(gps, "_validate_array", no_reference_work)
+    monkeypatch.setattr(gps.np, "round", no_reference_work)
+    result = gps.gps_match(locations1, locations2, backend="kdtree", columnar=True, cache=cache)
+    assert result.match_index.tolist() == expected.match_index.tolist()
+    assert cache.hits == 2
+
+def test_gps_match_cache_sees_modified_lists():
+    cache = gps.DistanceCache()
+    locations2 = [[10, 10], [20, 20]]
+    assert gps.gps_match([[9, 9]], locations2, cache=cache)[0][1] == [10, 10]
+    locations2.append([9, 9])
+    assert gps.gps_match([[9, 9]], locations2, cache=cache)[0][1] == [9, 9]
+    locations2.append([95, 0])
+    with pytest.raises(ValueError):
+        gps.gps_match([[89, 0]], locations2, cache=cache)
+    # only read-only reference sets are remembered, and not kept alive
+    assert not cache.remembers(locations2)
+    reference = gps.CoordinateArray.from_points(locations2[:3])
+    reference.lats.flags.writeable = reference.lons.flags.writeable = False
+    gps.gps_match([[9, 9]], reference, cache=cache)
+    assert cache.remembers(reference)
+    del reference
+    assert not cache._references
+
+def test_stream_ndarray_partial_batch():
+    rng = np.random.default_rng(10)
+    locations1 = np.column_stack([rng.uniform(-90, 90, 100), rng.uniform(-180, 180, 100)])
+    locations2 = [[0.0, 0.0], [45.0, 90.0], [-30.0, -60.0]]
+    # 64 rows take the whole-array check, the 36-row tail is checked per point
+    matches = list(gps.gps_match_stream(locations1, locations2, batch_size=64))
+    expected = gps.gps_match(locations1.tolist(), locations2)
+    assert len(matches) == 100
+    assert [match[1:] for match in matches] == [match[1:] for match in expected]
+    list(gps.gps_match_stream(np.zeros((100, 2)), locations2, batch_size=64))
+    gps.validate_coordinates([(np.float32(1.5), np.int64(2))])
+    gps.validate_coordinates([np.array([1.0, 2.0])])
+
+    index = gps.GPSIndex(locations1)
+    assert index.nearest(locations1[5])[0] == 5
+
+def test_default_backend_depends_on_both_sizes():
+    # a large reference set alone does not pay for building a tree
+    assert gps._choose_backend(None, 10, 100_000) == "numpy"
+    assert gps._choose_backend(None, 1_000, 1_000_000) == "numpy"
+    assert gps._choose_backend(None, 100_000, 20_000) == "numpy"
+    assert gps._choose_backend(None, 10_000, 100_000) == "kdtree"
+    assert gps._choose_backend(None, 10, 100_000, reused=True) == "kdtree"
+    assert gps._choose_backend(None, 10, 100) == "python"
+
+# def false():
+#     assert(False)
@@ -0,0 +1,103 @@
+import sys
+sys.path.insert(0, '.')
+import asyncio
+import json
+
+import pytest
+
+import service
+
+REFERENCE = [[42.3601, -71.0589], [41.8781, -87.6298], [40.7128, -74.0060]]  # Boston, Chicago, NYC
+
+
+def test_concurrent_requests_are_batched():
+    async def run():
+        matcher = service.MatchService(REFERENCE, batch_window=0.05)
+        results = await asyncio.gather(*(matcher.match(lat, lon) for lat, lon in REFERENCE * 10))
+        await matcher.close()
+        return matcher, results
+
+    matcher, results = asyncio.run(run())
+    assert [index for index, _ in results] == [0, 1, 2] * 10
+    assert all(distance == 0 for _, distance in results)
+    assert matcher.batches == 1
+
+
+def test_socket_protocol():
+    async def run():
+        matcher = service.MatchService(REFERENCE, batch_window=0.01)
+        server = await matcher.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        requests = [{"id": 1, "lat": 40.7, "lon": -74.0}, {"id": 2, "lat": 95, "lon": 0}, {"id": 3}]
+        for request in requests:
+            writer.write(json.dumps(request).encode() + b"\n")
+        writer.write(b"not json\n")
+        await writer.drain()
+
+        replies = [json.loads(await reader.readline()) for _ in range(4)]
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        await matcher.close()
+        return replies
+
+    replies = {reply["id"]: reply for reply in asyncio.run(run())}
+    assert replies[1]["index"] == 2
+    assert replies[1]["point"] == REFERENCE[2]
+    assert 0 < replies[1]["distance"] < 5
+    assert "latitude" in replies[2]["error"]
+    assert "error" in replies[3]
+    assert "error" in replies[None]
+
+
+def test_stored_tree_is_not_rebuilt(tmp_path, monkeypatch):
+    import gps
+    path = tmp_path / "cities.gpsref"
+    gps.save_reference(path, REFERENCE)
+
+    def rebuild(*args):
+        raise AssertionError("reference set indexed again")
+    monkeypatch.setattr(gps.SphereKDTree, "_build", rebuild)
+    monkeypatch.setattr(gps, "_ReferenceTable", rebuild)
+    locations, tree = gps.open_reference_tree(path)
+
+    async def run():
+        matcher = service.MatchService(locations, batch_window=0.01, tree=tree)
+        return await asyncio.gather(*(matcher.match(lat, lon) for lat, lon in REFERENCE))
+
+    assert [index for index, _ in asyncio.run(run())] == [0, 1, 2]
+
+
+def test_client_gone_before_reply():
+    class ResetWriter:
+        def is_closing(self):
+            return False
+
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            raise ConnectionResetError("client went away")
+
+    async def run():
+        matcher = service.MatchService(REFERENCE, batch_window=0.01)
+        await matcher._reply({"id": 1, "lat": 40.7, "lon": -74.0}, ResetWriter())
+        await matcher.close()
+
+    asyncio.run(run())
+
+
+def test_close_stops_batching():
+    async def run():
+        matcher = service.MatchService(REFERENCE, batch_window=10)
+        waiting = asyncio.ensure_future(matcher.match(40.7, -74.0))
+        await asyncio.sleep(0.01)
+        batcher = matcher._batcher
+        await matcher.close()
+        assert batcher.done()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(run())
@@ -2,8 +2,222 @@ import asyncio
 import json
 import uuid
 import time
+import heapq
 import hashlib
-from typing import Dict, List, Set, Optional
+import random
+import struct
+from collections import OrderedDict, deque
+from typing import Dict, List, Set, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # JSON framing only
+    msgpack = None
+
+# Kademlia parameters: bucket size, lookup concurrency and node ID length
+K = 20
+ALPHA = 3
+ID_BITS = 160
+
+# Seconds to wait for a hello_ack, a find_node_reply or any other reply
+HANDSHAKE_TIMEOUT = 5
+LOOKUP_TIMEOUT = 5
+REQUEST_TIMEOUT = 10
+
+# Reply type of each request type; replies carry the request's request_id
+REPLY_TYPES = {"hello": "hello_ack", "chat": "message_ack", "find_node": "find_node_reply", "store": "store_ack"}
+
+# Wire formats a node can speak, most preferred first. Every connection
+# starts with newline-delimited JSON; the hello offers the others, and
+# after hello_ack both sides switch to the one the peer picked. "msgpack"
+# frames are a 4-byte big-endian length followed by a msgpack payload.
+FRAMINGS = ("msgpack", "json") if msgpack is not None else ("json",)
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Buckets with no lookup in this many seconds are refreshed
+BUCKET_REFRESH_INTERVAL = 3600
+
+# Open peer connections beyond which the least recently used idle one is closed
+MAX_CONNECTIONS = 64
+
+# Frames a connection's send queue holds before the send policy applies:
+# "block" makes senders wait for room, "drop" discards the new frame
+SEND_QUEUE_DEPTH = 1024
+SEND_POLICIES = ("block", "drop")
+
+
+def xor_distance(a: str, b: str) -> int:
+    """XOR distance between two hex node IDs"""
+    return int(a, 16) ^ int(b, 16)
+
+
+def as_contact(value) -> Optional[tuple]:
+    """A (host, port, username) contact from a peer's reply, or None if value is not one"""
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        return None
+    host, port, username = value
+    if not isinstance(host, str) or not isinstance(port, int) or isinstance(port, bool) or not isinstance(username, str):
+        return None
+    return (host, port, username)
+
+
+class RoutingTable:
+    """Kademlia routing table: k-buckets of contacts by XOR distance from our node ID"""
+
+    def __init__(self, node_id: str, k: int = K):
+        self.node_id = node_id
+        self.k = k
+        # Bucket i holds contacts at distance [2**i, 2**(i+1)), least recently seen first
+        self.buckets: List[OrderedDict] = [OrderedDict() for _ in range(ID_BITS)]
+        # Contacts seen while their bucket was full, to replace ones that go away
+        self.replacements: List[OrderedDict] = [OrderedDict() for _ in range(ID_BITS)]
+        # When each bucket's range was last looked up
+        self.last_lookup: List[float] = [time.monotonic()] * ID_BITS
+
+    def bucket_index(self, node_id: str) -> int:
+        """Index of the bucket a node ID belongs in"""
+        return xor_distance(self.node_id, node_id).bit_length() - 1
+
+    def add(self, node_id: str, contact: tuple) -> bool:
+        """Record that a contact (host, port, username) was seen; False if its bucket is full"""
+        if node_id == self.node_id:
+            return False
+
+        index = self.bucket_index(node_id)
+        bucket = self.buckets[index]
+        if node_id in bucket or len(bucket) < self.k:
+            bucket[node_id] = contact
+            bucket.move_to_end(node_id)
+            return True
+
+        replacements = self.replacements[index]
+        replacements[node_id] = contact
+        replacements.move_to_end(node_id)
+        if len(replacements) > self.k:
+            replacements.popitem(last=False)
+        return False
+
+    def remove(self, node_id: str):
+        """Drop an unresponsive contact, promoting the most recently seen replacement"""
+        if node_id == self.node_id:
+            return
+
+        index = self.bucket_index(node_id)
+        self.replacements[index].pop(node_id, None)
+        if self.buckets[index].pop(node_id, None) is not None and self.replacements[index]:
+            replacement_id, contact = self.replacements[index].popitem()
+            self.buckets[index][replacement_id] = contact
+
+    def closest(self, target_id: str, count: int) -> List[Tuple[str, tuple]]:
+        """Up to count (node_id, contact) pairs closest to target_id, closest first"""
+        contacts = [item for bucket in self.buckets for item in bucket.items()]
+        return heapq.nsmallest(count, contacts, key=lambda item: xor_distance(item[0], target_id))
+
+    def touch(self, target_id: str):
+        """Note a lookup of target_id, which counts as refreshing its bucket"""
+        if target_id != self.node_id:
+            self.last_lookup[self.bucket_index(target_id)] = time.monotonic()
+
+    def stale_buckets(self, interval: float) -> List[int]:
+        """Indices of non-empty buckets with no lookup in the last interval seconds"""
+        now = time.monotonic()
+        return [index for index, bucket in enumerate(self.buckets)
+                if bucket and now - self.last_lookup[index] > interval]
+
+    def random_id(self, index: int) -> str:
+        """Random node ID in the range of bucket index"""
+        distance = (1 << index) | random.getrandbits(index) if index else 1
+        return format(int(self.node_id, 16) ^ distance, f"0{ID_BITS // 4}x")
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id != self.node_id and node_id in self.buckets[self.bucket_index(node_id)]
+
+    def __len__(self) -> int:
+        return sum(len(bucket) for bucket in self.buckets)
+
+
+class SendQueue:
+    """
+    Outbound frames of one connection, written by a background task
+    
+    Senders only wait for room in the queue, not for the peer to read, so
+    a slow peer does not stall them until the queue is full. Frames queued
+    while the previous write drains go out together in one write.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, max_depth: int = SEND_QUEUE_DEPTH, policy: str = "block"):
+        if policy not in SEND_POLICIES:
+            raise ValueError(f"policy must be one of {SEND_POLICIES}, got {policy!r}")
+        
+        self.writer = writer
+        self.max_depth = max_depth
+        self.policy = policy
+        # Metrics: frames and writes so far, deepest the queue has been, frames dropped
+        self.sent = 0
+        self.writes = 0
+        self.high_water = 0
+        self.dropped = 0
+        
+        self._frames: deque = deque()
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+    
+    def __len__(self) -> int:
+        return len(self._frames)
+    
+    async def put(self, frame: bytes, policy: Optional[str] = None) -> bool:
+        """
+        Queue a frame; False if it was dropped because the queue is full
+        
+        policy overrides the queue's own for this frame.
+        """
+        while len(self._frames) >= self.max_depth and not self._closed:
+            if (policy or self.policy) == "drop":
+                self.dropped += 1
+                return False
+            self._room.clear()
+            await self._room.wait()
+        
+        if self._closed:
+            raise ConnectionError("connection closed")
+        
+        self._frames.append(frame)
+        self.high_water = max(self.high_water, len(self._frames))
+        self._ready.set()
+        return True
+    
+    async def _run(self):
+        try:
+            while True:
+                await self._ready.wait()
+                frames = self._frames
+                self._frames = deque()
+                self._ready.clear()
+                self._room.set()
+                
+                self.writer.write(b"".join(frames))
+                self.sent += len(frames)
+                self.writes += 1
+                await self.writer.drain()
+        except (ConnectionError, OSError) as e:
+            print(f"Send queue stopped: {e!r}")
+        finally:
+            self._closed = True
+            self._room.set()
+    
+    def close(self):
+        """Stop writing; frames still queued are discarded and blocked senders fail"""
+        self._closed = True
+        self._room.set()
+        self._task.cancel()
+    
+    def stats(self) -> dict:
+        return {"queued": len(self._frames), "high_water": self.high_water, "sent": self.sent,
+                "writes": self.writes, "dropped": self.dropped}
+
 
 class Node:
     def __init__(self, host: str, port: int, username: str):
@@ -20,6 +234,23 @@ class Node:
         self.messages: Dict[str, List[dict]] = {}
         # DHT storage (node_id -> (host, port, username))
         self.dht_store: Dict[str, tuple] = {}
+        # Kademlia k-buckets of peers that have talked to us
+        self.routing = RoutingTable(self.node_id)
+        # Requests awaiting a reply, oldest first:
+        # {request_id: (future of the reply, connection it was sent on, reply type)}
+        self._pending: Dict[str, Tuple[asyncio.Future, asyncio.StreamWriter, str]] = {}
+        # Wire formats we offer and accept, and the one agreed on each connection
+        self.framings: Tuple[str, ...] = FRAMINGS
+        self._framing: Dict[asyncio.StreamWriter, str] = {}
+        # Registered connections, least recently used first
+        self.max_connections = MAX_CONNECTIONS
+        self._recent: OrderedDict = OrderedDict()
+        # Outbound connections being set up: {(host, port): task}
+        self._dials: Dict[Tuple[str, int], asyncio.Task] = {}
+        # Send queue of each connection, and how they behave when full
+        self.send_queue_depth = SEND_QUEUE_DEPTH
+        self.send_policy = "block"
+        self._queues: Dict[asyncio.StreamWriter, SendQueue] = {}
         
     async def start(self):
         """Start the node server and bootstrap if needed"""
@@ -44,16 +275,17 @@ class Node:
         
         try:
             while True:
-                data = await reader.readline()
-                if not data:
+                message = await self._read_message(reader, writer)
+                if message is None:
                     break
                     
-                message = json.loads(data.decode())
+                self._touch(writer)
                 await self._process_message(message, writer)
                 
         except Exception as e:
             print(f"Error handling connection: {e}")
         finally:
+            self._forget_connection(writer)
             writer.close()
             await writer.wait_closed()
             print(f"Connection from {peer_addr} closed")
@@ -62,22 +294,33 @@ class Node:
         """Process incoming messages based on type"""
         msg_type = message.get("type")
         
-        if msg_type == "hello":
+        if msg_type in REPLY_TYPES.values():
+            self._resolve_reply(message, writer)
+        
+        elif msg_type == "hello":
             # Handle peer introduction
             peer_id = message.get("node_id")
             username = message.get("username")
             host = message.get("host") 
             port = message.get("port")
             
-            self.peers[peer_id] = (host, port, username)
-            self.connections[peer_id] = writer
+            self._add_contact(peer_id, (host, port, username))
             
-            # Send acknowledgment
-            await self._send_message({
+            # Pick the first wire format offered that we speak; peers that
+            # offer none only speak JSON
+            offered = message.get("framings") or ["json"]
+            framing = next((f for f in offered if f in self.framings), "json")
+            
+            # Send acknowledgment, the last message in JSON
+            await self._send_reply({
                 "type": "hello_ack",
+                "request_id": message.get("request_id"),
                 "node_id": self.node_id,
-                "username": self.username
+                "username": self.username,
+                "framing": framing
             }, writer)
+            self._framing[writer] = framing
+            self._register_connection(peer_id, writer)
             
         elif msg_type == "chat":
             # Handle chat message
@@ -98,8 +341,9 @@ class Node:
             print(f"Message from {sender_name}: {content}")
             
             # Send acknowledgment
-            await self._send_message({
+            await self._send_reply({
                 "type": "message_ack",
+                "request_id": message.get("request_id"),
                 "message_id": message.get("message_id")
             }, writer)
             
@@ -107,19 +351,23 @@ class Node:
             # DHT node lookup
             target_id = message.get("target_id")
             if target_id in self.dht_store:
-                await self._send_message({
+                await self._send_reply({
                     "type": "find_node_reply",
+                    "request_id": message.get("request_id"),
+                    "sender_id": self.node_id,
                     "target_id": target_id,
                     "found": True,
                     "node_info": self.dht_store[target_id]
                 }, writer)
             else:
                 # Return closest nodes we know
-                await self._send_message({
+                await self._send_reply({
                     "type": "find_node_reply",
+                    "request_id": message.get("request_id"),
+                    "sender_id": self.node_id,
                     "target_id": target_id,
                     "found": False,
-                    "closest_nodes": self._get_closest_nodes(target_id, 3)
+                    "closest_nodes": self._get_closest_nodes(target_id, K)
                 }, writer)
         
         elif msg_type == "store":
@@ -128,37 +376,146 @@ class Node:
             value = message.get("value")
             self.dht_store[key] = value
             
-            await self._send_message({
+            await self._send_reply({
                 "type": "store_ack",
+                "request_id": message.get("request_id"),
                 "key": key
             }, writer)
     
-    async def _send_message(self, message: dict, writer: asyncio.StreamWriter):
-        """Send a message through an established connection"""
-        data = json.dumps(message).encode() + b'\n'
-        writer.write(data)
-        await writer.drain()
+    async def _send_message(self, message: dict, writer: asyncio.StreamWriter,
+                            policy: Optional[str] = None) -> bool:
+        """
+        Queue a message on an established connection
+        
+        Returns False if the connection's send queue is full and the send
+        policy is "drop"; with "block", waits for room instead. policy
+        overrides self.send_policy for this message.
+        """
+        self._touch(writer)
+        queue = self._queues.get(writer)
+        if queue is None:
+            queue = self._queues[writer] = SendQueue(writer, self.send_queue_depth, self.send_policy)
+        return await queue.put(self._encode(message, writer), policy)
+    
+    async def _send_reply(self, message: dict, writer: asyncio.StreamWriter):
+        """
+        Queue a reply without ever waiting for room
+        
+        Replies are sent from the connection's read loop, which must not
+        stall behind a peer that stops reading. A reply that does not fit
+        is dropped and the peer's request times out.
+        """
+        if not await self._send_message(message, writer, policy="drop"):
+            print(f"Dropped {message['type']}: send queue full")
+    
+    def send_queue_stats(self) -> Dict[str, dict]:
+        """Send queue metrics of each peer connection: queued frames, high water mark, frames sent, writes, drops"""
+        return {peer_id: self._queues[writer].stats()
+                for peer_id, writer in self.connections.items() if writer in self._queues}
+    
+    def _encode(self, message: dict, writer: asyncio.StreamWriter) -> bytes:
+        """Frame a message in the wire format of a connection"""
+        if self._framing.get(writer) == "msgpack":
+            payload = msgpack.packb(message)
+            return FRAME_HEADER.pack(len(payload)) + payload
+        return json.dumps(message).encode() + b'\n'
+    
+    async def _read_message(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[dict]:
+        """Read the next message in the wire format of a connection; None once it is closed"""
+        if self._framing.get(writer) == "msgpack":
+            try:
+                header = await reader.readexactly(FRAME_HEADER.size)
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Frame of {length} bytes is too large")
+                return msgpack.unpackb(await reader.readexactly(length))
+            except asyncio.IncompleteReadError:
+                return None
+        
+        data = await reader.readline()
+        if not data:
+            return None
+        return json.loads(data.decode())
+    
+    async def _request(self, message: dict, writer: asyncio.StreamWriter,
+                       timeout: float = REQUEST_TIMEOUT) -> dict:
+        """
+        Send a request and wait for the reply carrying its request_id
+        
+        Any number of requests can be outstanding on one connection, and
+        replies may come back in any order. Peers running the older
+        protocol do not echo request_id; see _resolve_reply. Raises asyncio.TimeoutError if
+        the request is not sent and answered within timeout, and ConnectionError if the
+        connection closes first, or asyncio.QueueFull if the request is
+        dropped by a full send queue. Cancelling the caller abandons the
+        request, and a late reply is ignored.
+        """
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = (future, writer, REPLY_TYPES[message["type"]])
+        try:
+            # Waiting for room in the send queue counts against the timeout
+            async with asyncio.timeout(timeout):
+                if not await self._send_message({**message, "request_id": request_id}, writer):
+                    raise asyncio.QueueFull()
+                return await future
+        finally:
+            del self._pending[request_id]
+    
+    def _resolve_reply(self, message: dict, writer: asyncio.StreamWriter):
+        """Hand a reply to the request waiting for it, if any"""
+        request_id = message.get("request_id")
+        if request_id is not None:
+            pending = self._pending.get(request_id)
+        else:
+            # Older peers reply without request_id, one request at a time in
+            # order, so the reply is for the oldest request of its type
+            pending = next((entry for entry in self._pending.values()
+                            if entry[1] is writer and entry[2] == message.get("type") and not entry[0].done()), None)
+        
+        if pending is not None and not pending[0].done():
+            pending[0].set_result(message)
     
     async def connect_to_peer(self, host: str, port: int):
-        """Establish connection to a new peer"""
+        """
+        Establish connection to a new peer, returning once it has acknowledged our hello
+        
+        Concurrent calls for the same address share one connection attempt.
+        """
+        key = (host, port)
+        dial = self._dials.get(key)
+        if dial is None:
+            dial = asyncio.create_task(self._dial(host, port))
+            self._dials[key] = dial
+            dial.add_done_callback(lambda _: self._dials.pop(key, None))
+        # One caller giving up does not abort the dial for the others
+        return await asyncio.shield(dial)
+    
+    async def _dial(self, host: str, port: int) -> bool:
+        """Open a connection to a peer and exchange hellos"""
+        self._make_room()
+        writer = None
         try:
             reader, writer = await asyncio.open_connection(host, port)
             
-            # Send hello message
-            await self._send_message({
+            # Start task to handle responses
+            asyncio.create_task(self._handle_peer_connection(reader, writer))
+            
+            # Send hello message; the peer is registered when its hello_ack arrives
+            await self._request({
                 "type": "hello",
                 "node_id": self.node_id,
                 "username": self.username,
                 "host": self.host,
-                "port": self.port
-            }, writer)
-            
-            # Start task to handle responses
-            asyncio.create_task(self._handle_peer_connection(reader, writer))
-            
+                "port": self.port,
+                "framings": list(self.framings)
+            }, writer, HANDSHAKE_TIMEOUT)
             return True
         except Exception as e:
             print(f"Failed to connect to peer {host}:{port}: {e}")
+            if writer is not None:
+                self._forget_connection(writer)
+                writer.close()
             return False
     
     async def _handle_peer_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
@@ -168,21 +525,26 @@ class Node:
         
         try:
             while True:
-                data = await reader.readline()
-                if not data:
+                message = await self._read_message(reader, writer)
+                if message is None:
                     break
                 
-                message = json.loads(data.decode())
-                
+                self._touch(writer)
                 if message.get("type") == "hello_ack":
-                    # Got acknowledgment, save the connection
+                    # Got acknowledgment, switch to the wire format the peer picked and save the connection
                     peer_id = message.get("node_id")
                     username = message.get("username")
                     host, port = peer_addr
                     
-                    self.peers[peer_id] = (host, port, username)
-                    self.connections[peer_id] = writer
+                    framing = message.get("framing", "json")
+                    if framing not in self.framings:
+                        raise ValueError(f"Peer picked unsupported framing {framing!r}")
+                    self._framing[writer] = framing
+                    
+                    self._add_contact(peer_id, (host, port, username))
+                    self._register_connection(peer_id, writer)
                     print(f"Registered peer {username} ({peer_id})")
+                    self._resolve_reply(message, writer)
                 else:
                     # Process other message types
                     await self._process_message(message, writer)
@@ -190,24 +552,22 @@ class Node:
         except Exception as e:
             print(f"Error in peer connection: {e}")
         finally:
+            self._forget_connection(writer)
             writer.close()
             await writer.wait_closed()
             print(f"Connection to {peer_addr} closed")
     
     async def send_chat_message(self, peer_id: str, content: str):
-        """Send a chat message to a specific peer"""
-        if peer_id not in self.connections:
-            # Try to find and connect to the peer
-            if peer_id in self.peers:
-                host, port, _ = self.peers[peer_id]
-                success = await self.connect_to_peer(host, port)
-                if not success:
-                    return False
-            else:
-                # Try to find the peer through DHT
-                found = await self._find_node(peer_id)
-                if not found:
-                    return False
+        """Send a chat message to a specific peer, returning True once it is acknowledged"""
+        if peer_id in self.peers:
+            writer = await self._get_connection(peer_id)
+        elif await self._find_node(peer_id):
+            # Found the peer through DHT
+            writer = self.connections.get(peer_id)
+        else:
+            writer = None
+        if writer is None:
+            return False
         
         message = {
             "type": "chat",
@@ -218,35 +578,159 @@ class Node:
             "timestamp": time.time()
         }
         
-        await self._send_message(message, self.connections[peer_id])
+        try:
+            await self._request(message, writer)
+        except (asyncio.TimeoutError, asyncio.QueueFull, ConnectionError) as e:
+            print(f"Message to {peer_id} not acknowledged: {e!r}")
+            return False
+        return True
+    
+    async def store(self, peer_id: str, key: str, value) -> bool:
+        """Store a key in a peer's DHT storage, returning True once it is acknowledged"""
+        writer = await self._get_connection(peer_id)
+        if writer is None:
+            return False
+        
+        try:
+            await self._request({"type": "store", "key": key, "value": value}, writer)
+        except (asyncio.TimeoutError, asyncio.QueueFull, ConnectionError) as e:
+            print(f"Store on {peer_id} not acknowledged: {e!r}")
+            return False
         return True
     
     async def _find_node(self, node_id: str) -> bool:
-        """Find a node in the DHT network"""
-        # Implementation of Kademlia-like lookup
-        # For simplicity, just try known peers
-        for peer_id, (host, port, _) in self.peers.items():
-            if peer_id not in self.connections:
-                success = await self.connect_to_peer(host, port)
-                if not success:
-                    continue
+        """Find a node in the DHT network and connect to it"""
+        if node_id not in self.peers:
+            for peer_id, contact in await self.lookup(node_id):
+                if peer_id == node_id:
+                    self.peers[peer_id] = contact
+        
+        if node_id not in self.peers:
+            return False  # Not found
+        return await self._get_connection(node_id) is not None
+    
+    async def lookup(self, target_id: str) -> List[Tuple[str, tuple]]:
+        """
+        Iterative Kademlia lookup: the K nodes closest to target_id, closest first
+        
+        Each round asks the ALPHA closest nodes not yet asked, in parallel,
+        for the nodes they know closest to the target. The lookup ends when
+        the K closest nodes found have all been asked. If a node has the
+        target in its DHT store, that is returned alone.
+        """
+        self.routing.touch(target_id)
+        distance = lambda node_id: xor_distance(node_id, target_id)
+        
+        shortlist = dict(self.routing.closest(target_id, K))
+        queried: Set[str] = set()
+        while True:
+            closest = heapq.nsmallest(K, shortlist, key=distance)
+            batch = [peer_id for peer_id in closest if peer_id not in queried][:ALPHA]
+            if not batch:
+                break
             
-            # Ask this peer about the target node
-            writer = self.connections[peer_id]
-            await self._send_message({
+            queried.update(batch)
+            replies = await asyncio.gather(*(self._query_peer(peer_id, target_id) for peer_id in batch))
+            for peer_id, reply in zip(batch, replies):
+                if reply is None:
+                    shortlist.pop(peer_id, None)
+                    continue
+                # The DHT store also holds values put there by store(), which
+                # are not contacts; a reply with one has not found the node
+                contact = as_contact(reply.get("node_info")) if reply.get("found") else None
+                if contact is not None:
+                    return [(target_id, contact)]
+                
+                for entry in reply.get("closest_nodes", []):
+                    # Older peers send [node_id, [host, port, username]]
+                    node_id, host, port, username = entry if len(entry) == 4 else (entry[0], *entry[1])
+                    if node_id != self.node_id and node_id not in queried:
+                        shortlist.setdefault(node_id, (host, port, username))
+                        self.peers.setdefault(node_id, (host, port, username))
+        
+        return sorted(shortlist.items(), key=lambda item: distance(item[0]))[:K]
+    
+    async def _query_peer(self, peer_id: str, target_id: str) -> Optional[dict]:
+        """Send find_node to a peer and wait for its reply; None if it does not answer"""
+        writer = await self._get_connection(peer_id)
+        if writer is None:
+            self.routing.remove(peer_id)
+            return None
+        
+        try:
+            reply = await self._request({
                 "type": "find_node",
-                "target_id": node_id
-            }, writer)
-            
-            # In a real implementation, wait for and process the response
-            # This is simplified
-            
-        return False  # Not found
+                "sender_id": self.node_id,
+                "target_id": target_id
+            }, writer, LOOKUP_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.QueueFull, ConnectionError) as e:
+            print(f"No find_node reply from {peer_id}: {e!r}")
+            self.routing.remove(peer_id)
+            return None
+        
+        self.routing.add(peer_id, self.peers[peer_id])
+        return reply
+    
+    async def _get_connection(self, peer_id: str) -> Optional[asyncio.StreamWriter]:
+        """Connection to a known peer, reused if open, connecting first if needed; None if that fails"""
+        if peer_id not in self.connections and peer_id in self.peers:
+            host, port, _ = self.peers[peer_id]
+            await self.connect_to_peer(host, port)
+        return self.connections.get(peer_id)
+    
+    def _register_connection(self, peer_id: str, writer: asyncio.StreamWriter):
+        """Use a connection for a peer once hellos are exchanged"""
+        if writer not in self._recent:
+            self._make_room()
+        self.connections[peer_id] = writer
+        self._recent[writer] = None
+    
+    def _touch(self, writer: asyncio.StreamWriter):
+        """Mark a connection as just used"""
+        if writer in self._recent:
+            self._recent.move_to_end(writer)
+    
+    def _make_room(self):
+        """Close least recently used idle connections until there is room for another"""
+        while len(self._recent) >= self.max_connections:
+            busy = {connection for _, connection, _ in self._pending.values()}
+            busy.update(writer for writer, queue in self._queues.items() if len(queue))
+            idle = next((writer for writer in self._recent if writer not in busy), None)
+            if idle is None:
+                # Every connection has a request in flight; go over the cap rather than fail
+                return
+            print(f"Closing idle connection to {idle.get_extra_info('peername')}")
+            self._forget_connection(idle)
+            idle.close()
+    
+    def _get_closest_nodes(self, target_id: str, count: int) -> List[list]:
+        """Get closest nodes to a target ID based on XOR distance, as [node_id, host, port, username]"""
+        return [[node_id, *contact] for node_id, contact in self.routing.closest(target_id, count)]
+    
+    def _add_contact(self, peer_id: str, contact: tuple):
+        """Record a peer that has talked to us"""
+        self.peers[peer_id] = contact
+        self.routing.add(peer_id, contact)
+    
+    def _forget_connection(self, writer: asyncio.StreamWriter):
+        """Drop a closed connection so it is not written to again, failing its outstanding requests"""
+        for peer_id, connection in list(self.connections.items()):
+            if connection is writer:
+                del self.connections[peer_id]
+        self._framing.pop(writer, None)
+        self._recent.pop(writer, None)
+        queue = self._queues.pop(writer, None)
+        if queue is not None:
+            queue.close()
+        
+        for future, connection, _ in self._pending.values():
+            if connection is writer and not future.done():
+                future.set_exception(ConnectionError("connection closed"))
     
-    def _get_closest_nodes(self, target_id: str, count: int) -> List[tuple]:
-        """Get closest nodes to a target ID based on XOR distance"""
-        # Simplified implementation - in a real system use XOR metric
-        return list(self.peers.items())[:count]
+    async def _refresh_buckets(self):
+        """Look up a random ID in every bucket that has not seen a lookup for a while"""
+        for index in self.routing.stale_buckets(BUCKET_REFRESH_INTERVAL):
+            await self.lookup(self.routing.random_id(index))
     
     async def _periodic_cleanup(self):
         """Periodic task to clean up stale connections"""
@@ -258,12 +742,14 @@ class Node:
         """Periodic task to discover new peers"""
         while True:
             await asyncio.sleep(300)  # Run every 5 minutes
-            # Discovery logic here
+            await self._refresh_buckets()
     
     async def bootstrap(self, known_host: str, known_port: int):
         """Bootstrap this node by connecting to a known peer"""
         success = await self.connect_to_peer(known_host, known_port)
         if success:
+            # Looking up our own ID fills the buckets closest to us
+            await self.lookup(self.node_id)
             print(f"Successfully bootstrapped with {known_host}:{known_port}")
         else:
             print(f"Failed to bootstrap with {known_host}:{known_port}")
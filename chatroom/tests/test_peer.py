@@ -0,0 +1,414 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import peer
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def start_nodes(count):
+    """Start count nodes on localhost, each bootstrapped from the first"""
+    nodes = [peer.Node("127.0.0.1", free_port(), f"user{i}") for i in range(count)]
+    tasks = [asyncio.create_task(node.start()) for node in nodes]
+    await asyncio.sleep(0.1)
+    for node in nodes[1:]:
+        await node.bootstrap(nodes[0].host, nodes[0].port)
+    return nodes, tasks
+
+
+async def stop_nodes(tasks, nodes=()):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for node in nodes:
+        for writer in list(node._recent):
+            node._forget_connection(writer)
+            writer.close()
+    await asyncio.sleep(0.01)
+
+
+def node_id(distance, own="0" * 40):
+    return format(int(own, 16) ^ distance, "040x")
+
+
+def test_routing_table_buckets():
+    table = peer.RoutingTable("0" * 40, k=2)
+    assert table.bucket_index(node_id(1)) == 0
+    assert table.bucket_index(node_id(0b1010)) == 3
+    assert table.bucket_index(table.random_id(7)) == 7
+
+    # bucket 3 holds distances 8 to 15
+    assert table.add(node_id(8), ("h", 8, "a"))
+    assert table.add(node_id(9), ("h", 9, "b"))
+    assert not table.add(node_id(10), ("h", 10, "c"))
+    assert node_id(10) not in table and len(table) == 2
+
+    # the replacement takes over when a contact goes away
+    table.remove(node_id(8))
+    assert node_id(10) in table and node_id(8) not in table
+
+    assert not table.add("0" * 40, ("h", 0, "me"))
+
+
+def test_routing_table_closest():
+    table = peer.RoutingTable("0" * 40)
+    for distance in (1, 2, 3, 100, 200):
+        table.add(node_id(distance), ("h", distance, ""))
+    target = node_id(99)
+    closest = [contact[1] for _, contact in table.closest(target, 3)]
+    # 99 ^ 100 = 7, 99 ^ 3 = 96, 99 ^ 2 = 97
+    assert closest == [100, 3, 2]
+
+
+def test_stale_buckets():
+    table = peer.RoutingTable("0" * 40)
+    table.add(node_id(5), ("h", 5, ""))
+    assert table.stale_buckets(3600) == []
+    assert table.stale_buckets(-1) == [2]
+    table.touch(node_id(6))
+    assert table.stale_buckets(0.5) == []
+
+
+@pytest.mark.asyncio
+async def test_lookup_finds_node_through_others():
+    nodes, tasks = await start_nodes(8)
+    try:
+        # the last node only knows the first, which knows everyone
+        seeker, target = nodes[-1], nodes[3]
+        contacts = await seeker.lookup(target.node_id)
+        assert contacts[0][0] == target.node_id
+        assert await seeker._find_node(target.node_id)
+        assert target.node_id in seeker.connections
+        assert await seeker.send_chat_message(target.node_id, "hi")
+        await asyncio.sleep(0.1)
+        assert target.messages[seeker.node_id][0]["content"] == "hi"
+    finally:
+        await stop_nodes(tasks, nodes)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("value", [42, "a string", ["127.0.0.1", 1], [1, 2, 3]])
+async def test_lookup_ignores_stored_values_that_are_not_contacts(value):
+    nodes, tasks = await start_nodes(4)
+    try:
+        seeker, target = nodes[-1], nodes[2]
+        assert await seeker.store(nodes[0].node_id, target.node_id, value)
+        contacts = await seeker.lookup(target.node_id)
+        assert contacts[0] == (target.node_id, (target.host, target.port, target.username))
+        assert await seeker.send_chat_message(target.node_id, "hi")
+    finally:
+        await stop_nodes(tasks, nodes)
+
+
+@pytest.mark.asyncio
+async def test_lookup_skips_dead_peers():
+    nodes, tasks = await start_nodes(4)
+    try:
+        seeker = nodes[3]
+        dead_id = node_id(1, nodes[1].node_id)
+        seeker._add_contact(dead_id, ("127.0.0.1", free_port(), "gone"))
+
+        contacts = await seeker.lookup(nodes[1].node_id)
+        assert contacts[0][0] == nodes[1].node_id
+        assert dead_id not in seeker.routing
+        assert dead_id not in [peer_id for peer_id, _ in contacts]
+    finally:
+        await stop_nodes(tasks, nodes)
+
+
+async def silent_server(close=False):
+    """Server that reads requests and never replies, or closes the connection on the first one"""
+    async def handle(reader, writer):
+        await reader.readline()
+        if close:
+            writer.close()
+            return
+        await reader.read()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    return server, reader, writer
+
+
+@pytest.mark.asyncio
+async def test_pipelined_requests():
+    nodes, tasks = await start_nodes(2)
+    try:
+        sender, receiver = nodes[1], nodes[0]
+        results = await asyncio.gather(
+            *(sender.store(receiver.node_id, f"key{i}", i) for i in range(20)),
+            *(sender.send_chat_message(receiver.node_id, f"message {i}") for i in range(20)),
+        )
+        assert all(results)
+        assert len(sender.connections) == 1
+        assert receiver.dht_store["key7"] == 7
+        assert len(receiver.messages[sender.node_id]) == 20
+        assert sender._pending == {}
+    finally:
+        await stop_nodes(tasks, nodes)
+
+
+@pytest.mark.asyncio
+async def test_request_timeout_and_cancellation():
+    node = peer.Node("127.0.0.1", free_port(), "user")
+    server, _, writer = await silent_server()
+    try:
+        with pytest.raises(asyncio.TimeoutError):
+            await node._request({"type": "store", "key": "k", "value": 1}, writer, timeout=0.1)
+        assert node._pending == {}
+
+        task = asyncio.create_task(node._request({"type": "store", "key": "k", "value": 1}, writer))
+        await asyncio.sleep(0.05)
+        assert len(node._pending) == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert node._pending == {}
+    finally:
+        node._forget_connection(writer)
+        writer.close()
+        server.close()
+
+
+@pytest.mark.asyncio
+async def test_request_fails_when_connection_closes():
+    node = peer.Node("127.0.0.1", free_port(), "user")
+    server, reader, writer = await silent_server(close=True)
+    handler = asyncio.create_task(node._handle_peer_connection(reader, writer))
+    try:
+        with pytest.raises(ConnectionError):
+            await node._request({"type": "store", "key": "k", "value": 1}, writer)
+    finally:
+        await handler
+        server.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("framings, expected", [
+    (peer.FRAMINGS, peer.FRAMINGS[0]),
+    (("json",), "json"),
+])
+async def test_framing_negotiation(framings, expected):
+    nodes, tasks = await start_nodes(1)
+    # a node that offers framings, e.g. JSON only like older peers
+    other = peer.Node("127.0.0.1", free_port(), "other")
+    other.framings = framings
+    tasks.append(asyncio.create_task(other.start()))
+    await asyncio.sleep(0.1)
+    try:
+        await other.bootstrap(nodes[0].host, nodes[0].port)
+        assert other._framing[other.connections[nodes[0].node_id]] == expected
+        assert nodes[0]._framing[nodes[0].connections[other.node_id]] == expected
+
+        assert await other.send_chat_message(nodes[0].node_id, "héllo")
+        assert await other.store(nodes[0].node_id, "key", {"nested": [1, 2.5, None]})
+        assert nodes[0].messages[other.node_id][0]["content"] == "héllo"
+        assert nodes[0].dht_store["key"] == {"nested": [1, 2.5, None]}
+    finally:
+        await stop_nodes(tasks, [*nodes, other])
+
+
+@pytest.mark.skipif(peer.msgpack is None, reason="msgpack is not installed")
+def test_msgpack_frame():
+    node = peer.Node("127.0.0.1", 0, "user")
+    writer = object()
+    node._framing[writer] = "msgpack"
+    frame = node._encode({"type": "chat", "content": "hi"}, writer)
+    (length,) = peer.FRAME_HEADER.unpack(frame[:4])
+    assert length == len(frame) - 4
+    assert len(frame) < len(node._encode({"type": "chat", "content": "hi"}, None))
+
+
+@pytest.mark.asyncio
+async def test_concurrent_dials_share_one_connection():
+    nodes, tasks = await start_nodes(1)
+    other = peer.Node("127.0.0.1", free_port(), "other")
+    try:
+        target = nodes[0]
+        other.peers[target.node_id] = (target.host, target.port, target.username)
+        results = await asyncio.gather(*(other.send_chat_message(target.node_id, f"burst {i}") for i in range(20)))
+        assert all(results)
+        assert len(other._recent) == 1
+        assert len(target._recent) == 1
+        assert len(target.messages[other.node_id]) == 20
+    finally:
+        await stop_nodes(tasks, [*nodes, other])
+
+
+@pytest.mark.asyncio
+async def test_connection_cap_evicts_least_recently_used():
+    nodes, tasks = await start_nodes(3)
+    client = peer.Node("127.0.0.1", free_port(), "client")
+    client.max_connections = 2
+    try:
+        for node in nodes:
+            client.peers[node.node_id] = (node.host, node.port, node.username)
+
+        assert await client.send_chat_message(nodes[0].node_id, "a")
+        assert await client.send_chat_message(nodes[1].node_id, "b")
+        assert await client.send_chat_message(nodes[0].node_id, "c")
+        # nodes[1] is now the least recently used
+        assert await client.send_chat_message(nodes[2].node_id, "d")
+        assert set(client.connections) == {nodes[0].node_id, nodes[2].node_id}
+
+        # and is reconnected on demand
+        assert await client.send_chat_message(nodes[1].node_id, "e")
+        assert len(client.connections) == 2
+        assert [m["content"] for m in nodes[1].messages[client.node_id]] == ["b", "e"]
+    finally:
+        await stop_nodes(tasks, [*nodes, client])
+
+
+class StalledWriter:
+    """Stream writer whose peer stops reading until released"""
+
+    def __init__(self):
+        self.written = []
+        self.released = asyncio.Event()
+
+    def write(self, data):
+        self.written.append(data)
+
+    async def drain(self):
+        await self.released.wait()
+
+
+@pytest.mark.asyncio
+async def test_send_queue_coalesces_writes():
+    nodes, tasks = await start_nodes(2)
+    try:
+        sender, receiver = nodes[1], nodes[0]
+        assert all(await asyncio.gather(*(sender.store(receiver.node_id, f"key{i}", i) for i in range(100))))
+        stats = sender.send_queue_stats()[receiver.node_id]
+        assert stats["queued"] == 0 and stats["dropped"] == 0
+        assert stats["sent"] >= 100
+        assert stats["writes"] < stats["sent"]
+        assert stats["high_water"] > 1
+    finally:
+        await stop_nodes(tasks, nodes)
+
+
+@pytest.mark.asyncio
+async def test_send_queue_drop_policy():
+    writer = StalledWriter()
+    queue = peer.SendQueue(writer, max_depth=2, policy="drop")
+    try:
+        assert await queue.put(b"1")
+        await asyncio.sleep(0)  # the first frame is written, its drain stalls
+        assert await queue.put(b"2")
+        assert await queue.put(b"3")
+        assert not await queue.put(b"4")
+        assert queue.dropped == 1 and len(queue) == 2
+
+        writer.released.set()
+        await asyncio.sleep(0.01)
+        # the frames queued behind the stall go out in one write
+        assert writer.written == [b"1", b"23"]
+        assert queue.stats()["writes"] == 2
+    finally:
+        queue.close()
+
+
+@pytest.mark.asyncio
+async def test_send_queue_block_policy():
+    writer = StalledWriter()
+    queue = peer.SendQueue(writer, max_depth=1)
+    try:
+        await queue.put(b"1")
+        await asyncio.sleep(0)
+        await queue.put(b"2")
+        blocked = asyncio.create_task(queue.put(b"3"))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        writer.released.set()
+        assert await blocked
+        await asyncio.sleep(0.01)
+        assert b"".join(writer.written) == b"123"
+    finally:
+        queue.close()
+
+    with pytest.raises(ValueError):
+        peer.SendQueue(writer, policy="wait")
+
+
+@pytest.mark.asyncio
+async def test_full_send_queue_does_not_stall_requests_or_replies():
+    node = peer.Node("127.0.0.1", free_port(), "user")
+    node.send_queue_depth = 1
+    writer = StalledWriter()
+    try:
+        # the first frame is written and stalls, the second fills the queue,
+        # and the rest wait for room: all of them must still time out
+        requests = [node._request({"type": "chat", "content": "x" * 1000}, writer, timeout=0.1)
+                    for _ in range(6)]
+        results = await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), 1)
+        assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+        assert node._pending == {}
+
+        # an ack on the still full queue is dropped instead of blocking the read loop
+        assert len(node._queues[writer]) == node.send_queue_depth
+        await asyncio.wait_for(node._process_message(
+            {"type": "chat", "sender_id": "a", "sender_name": "a", "content": "hi", "request_id": "1"}, writer), 1)
+        assert node._queues[writer].dropped == 1
+    finally:
+        node._forget_connection(writer)
+
+
+async def legacy_peer():
+    """Peer speaking the original protocol: JSON lines, replies without request_id"""
+    received = []
+
+    async def handle(reader, writer):
+        while line := await reader.readline():
+            message = json.loads(line)
+            received.append(message)
+            if message["type"] == "hello":
+                reply = {"type": "hello_ack", "node_id": "f" * 40, "username": "legacy"}
+            elif message["type"] == "chat":
+                reply = {"type": "message_ack", "message_id": message["message_id"]}
+            elif message["type"] == "store":
+                reply = {"type": "store_ack", "key": message["key"]}
+            else:
+                continue
+            writer.write(json.dumps(reply).encode() + b"\n")
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, received
+
+
+@pytest.mark.asyncio
+async def test_peer_without_request_ids():
+    server, received = await legacy_peer()
+    node = peer.Node("127.0.0.1", free_port(), "user")
+    host, port = server.sockets[0].getsockname()[:2]
+    try:
+        start = asyncio.get_running_loop().time()
+        assert await node.connect_to_peer(host, port)
+        assert asyncio.get_running_loop().time() - start < 1
+        assert node._framing[node.connections["f" * 40]] == "json"
+
+        # pipelined requests are matched to the in-order replies by type
+        results = await asyncio.gather(node.send_chat_message("f" * 40, "hi"),
+                                       node.store("f" * 40, "key", 1),
+                                       node.send_chat_message("f" * 40, "again"))
+        assert all(results)
+        assert [m["type"] for m in received] == ["hello", "chat", "store", "chat"]
+        assert node._pending == {}
+    finally:
+        for writer in list(node._recent):
+            node._forget_connection(writer)
+            writer.close()
+        server.close()